@@ -0,0 +1,469 @@
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import pytz
+
+import ListWorkItemsForIteration as export
+
+# the exports are ingested into this store next to the DevOps cache
+ANALYTICS_FILE_NAME = 'analytics.sqlite'
+# lead time percentiles reported per sprint
+LEAD_TIME_PERCENTILES = [50, 85, 95]
+
+# the columns of the sprint report. velocity adds up the business value of
+# the completed PBIs (the exports have no effort), throughput counts them.
+# utilisation is the completed work of their tasks (exported with --tasks)
+# over the capacity hours of the team
+sprint_metric_names = ['items', 'throughput', 'velocity'] + \
+    ['lead_time_p{0}'.format(p) for p in LEAD_TIME_PERCENTILES] + \
+    ['planned', 'unplanned', 'unplanned_ratio', 'capacity_hours', 'completed_work', 'utilisation']
+
+# the export columns kept in the store, by their header
+pbi_column_names = ['Id', 'WorkItemType', 'State', 'BusinessValue', 'CreatedDate', 'ChangedDate',
+    'IterationPath', 'Tags', 'Planned', 'CompletedWork']
+capacity_column_names = ['team_member', 'capacity_per_day', 'days_per_iteration', 'IterationPath', 'team']
+
+
+def _export_sources(folder):
+    # (path, format) of the exports in the folder, a dataset is one source
+    source_list = []
+    for file_name in sorted(os.listdir(folder)):
+        file_path = os.path.join(folder, file_name)
+        extension = file_name.split('.')[-1]
+        if file_name.startswith('.') or file_name.startswith('~$') or extension not in export.EXPORT_FORMATS:
+            continue
+        if (extension in export.DATASET_FORMATS) == os.path.isdir(file_path):
+            source_list.append((file_path, extension))
+    return source_list
+
+
+def _source_signature(file_path):
+    # changes whenever the export is written again
+    file_list = [file_path]
+    if os.path.isdir(file_path):
+        file_list = [os.path.join(root, file_name) for root, folders, file_names in os.walk(file_path)
+            for file_name in file_names]
+    stat_list = [os.stat(path) for path in file_list]
+    return "{0}:{1}:{2}".format(len(stat_list),
+        max([stat.st_mtime for stat in stat_list] or [0]), sum([stat.st_size for stat in stat_list]))
+
+
+def _iterate_source_rows(file_path, export_format):
+    # the rows of an export, header first
+    if export_format in export.DATASET_FORMATS:
+        pyarrow = export._import_pyarrow(export_format)
+        table = pyarrow.dataset.dataset(file_path, partitioning='hive',
+            format='parquet' if export_format == 'parquet' else 'ipc').to_table()
+        yield table.column_names
+        for row in table.to_pylist():
+            yield [row[column_name] for column_name in table.column_names]
+    else:
+        for row in export._iterate_export_rows(file_path, export_format):
+            yield row
+
+
+def _to_number(value):
+    if value is None or value == '':
+        return None
+    return float(value)
+
+
+def _to_seconds(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=pytz.utc)
+        return value.timestamp()
+    return export._date_seconds(str(value))
+
+
+def _to_text(value):
+    if value is None or value == '':
+        return None
+    return str(value)
+
+
+def _percentiles(sorted_values, percentiles):
+    # linear interpolation between the closest ranks, as numpy.percentile
+    values = []
+    for percentile in percentiles:
+        rank = (len(sorted_values) - 1) * percentile / 100.0
+        lower = int(rank)
+        upper = min(lower + 1, len(sorted_values) - 1)
+        values.append(sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower))
+    return values
+
+
+class AnalyticsStore:
+    # the rows of the PBI and capacity exports, indexed by iteration path,
+    # and the metrics of each sprint until one of its exports changes
+
+    def __init__(self, file_path):
+        folder = os.path.dirname(file_path)
+        if folder != '' and not os.path.exists(folder):
+            os.makedirs(folder)
+        self._db = sqlite3.connect(file_path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, signature TEXT, ingested REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS pbi_rows (source TEXT, iteration_path TEXT, id INTEGER, "
+            "work_item_type TEXT, state TEXT, business_value REAL, start_seconds REAL, finish_seconds REAL, "
+            "tags TEXT, planned TEXT, completed_work REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS pbi_rows_by_iteration ON pbi_rows (iteration_path, id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS pbi_rows_by_source ON pbi_rows (source)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS capacity_rows (source TEXT, iteration_path TEXT, "
+            "team TEXT, team_member TEXT, capacity_per_day REAL, days_per_iteration REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS capacity_rows_by_iteration ON capacity_rows (iteration_path, team, team_member)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS capacity_rows_by_source ON capacity_rows (source)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sprint_metrics (iteration_path TEXT PRIMARY KEY, metrics TEXT)")
+        self._db.commit()
+
+    def use_settings(self, settings):
+        # the metrics computed with other state categories or tag rules are dropped
+        settings = json.dumps(settings, sort_keys=True)
+        row = self._db.execute("SELECT value FROM settings WHERE name = 'metrics'").fetchone()
+        if row is None or row[0] != settings:
+            self._db.execute("DELETE FROM sprint_metrics")
+            self._db.execute("INSERT OR REPLACE INTO settings VALUES ('metrics', ?)", (settings,))
+            self._db.commit()
+
+    def sources(self):
+        return dict(self._db.execute("SELECT path, signature FROM sources").fetchall())
+
+    def _iteration_paths(self, source):
+        return set([row[0] for row in self._db.execute(
+            "SELECT DISTINCT iteration_path FROM pbi_rows WHERE source = ? "
+            "UNION SELECT DISTINCT iteration_path FROM capacity_rows WHERE source = ?", (source, source))])
+
+    def _invalidate(self, iteration_path_set):
+        self._db.executemany("DELETE FROM sprint_metrics WHERE iteration_path = ?",
+            [(iteration_path,) for iteration_path in iteration_path_set])
+
+    def forget(self, source):
+        # drop an export removed from the folder
+        iteration_path_set = self._iteration_paths(source)
+        self._db.execute("DELETE FROM pbi_rows WHERE source = ?", (source,))
+        self._db.execute("DELETE FROM capacity_rows WHERE source = ?", (source,))
+        self._db.execute("DELETE FROM sources WHERE path = ?", (source,))
+        self._invalidate(iteration_path_set)
+        self._db.commit()
+        return iteration_path_set
+
+    def ingest(self, source, export_format, signature):
+        # replace the rows of an export, returns the iteration paths it had or has now
+        iteration_path_set = self._iteration_paths(source)
+        self._db.execute("DELETE FROM pbi_rows WHERE source = ?", (source,))
+        self._db.execute("DELETE FROM capacity_rows WHERE source = ?", (source,))
+
+        row_count = 0
+        rows = _iterate_source_rows(source, export_format)
+        header = [str(column_name) for column_name in next(rows, [])]
+        if 'Id' in header and 'IterationPath' in header:
+            positions = [header.index(column_name) if column_name in header else None
+                for column_name in pbi_column_names]
+            row_list = []
+            for row in rows:
+                value_id, work_item_type, state, business_value, created_date, changed_date, \
+                    iteration_path, tags, planned, completed_work = \
+                    [None if position is None else row[position] for position in positions]
+                if value_id is None or value_id == '' or iteration_path is None:
+                    continue
+                row_list.append((source, iteration_path, int(float(value_id)), _to_text(work_item_type),
+                    _to_text(state), _to_number(business_value), _to_seconds(created_date),
+                    _to_seconds(changed_date), _to_text(tags), _to_text(planned), _to_number(completed_work)))
+                iteration_path_set.add(iteration_path)
+            self._db.executemany("INSERT INTO pbi_rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row_list)
+            row_count = len(row_list)
+        elif 'team_member' in header and 'IterationPath' in header:
+            positions = [header.index(column_name) if column_name in header else None
+                for column_name in capacity_column_names]
+            row_list = []
+            for row in rows:
+                team_member, capacity_per_day, days_per_iteration, iteration_path, team = \
+                    [None if position is None else row[position] for position in positions]
+                if iteration_path is None:
+                    continue
+                row_list.append((source, iteration_path, _to_text(team), _to_text(team_member),
+                    _to_number(capacity_per_day), _to_number(days_per_iteration)))
+                iteration_path_set.add(iteration_path)
+            self._db.executemany("INSERT INTO capacity_rows VALUES (?, ?, ?, ?, ?, ?)", row_list)
+            row_count = len(row_list)
+
+        self._db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (source, signature, time.time()))
+        self._invalidate(iteration_path_set)
+        self._db.commit()
+        return iteration_path_set, row_count
+
+    def stale_iteration_paths(self):
+        # the sprints without metrics, new or changed since the last report
+        return [row[0] for row in self._db.execute(
+            "SELECT iteration_path FROM pbi_rows UNION SELECT iteration_path FROM capacity_rows "
+            "EXCEPT SELECT iteration_path FROM sprint_metrics ORDER BY 1")]
+
+    def _select_by_iteration(self, query, iteration_path_list):
+        rows = []
+        # stay below the sqlite host parameter limit
+        for i in range(0, len(iteration_path_list), 500):
+            batch = iteration_path_list[i:i + 500]
+            rows.extend(self._db.execute(query.format(','.join('?' * len(batch))), batch).fetchall())
+        return rows
+
+    def pbi_rows(self, iteration_path_list):
+        # one row per work item and sprint, from the export ingested last
+        return [row[:-1] for row in self._select_by_iteration(
+            "SELECT iteration_path, work_item_type, state, business_value, start_seconds, finish_seconds, "
+            "tags, planned, completed_work, MAX(rowid) FROM pbi_rows WHERE iteration_path IN ({0}) "
+            "GROUP BY iteration_path, id", iteration_path_list)]
+
+    def capacity_rows(self, iteration_path_list):
+        return [row[:-1] for row in self._select_by_iteration(
+            "SELECT iteration_path, capacity_per_day, days_per_iteration, MAX(rowid) FROM capacity_rows "
+            "WHERE iteration_path IN ({0}) GROUP BY iteration_path, team, team_member", iteration_path_list)]
+
+    def save_metrics(self, sprint_metrics):
+        self._db.executemany("INSERT OR REPLACE INTO sprint_metrics VALUES (?, ?)",
+            [(iteration_path, json.dumps(metrics)) for iteration_path, metrics in sprint_metrics.items()])
+        self._db.commit()
+
+    def all_metrics(self):
+        return [(iteration_path, json.loads(metrics)) for iteration_path, metrics in self._db.execute(
+            "SELECT iteration_path, metrics FROM sprint_metrics ORDER BY iteration_path")]
+
+    def close(self):
+        self._db.close()
+
+
+def _pbi_columns(pbi_rows, state_categories, tag_classifier):
+    # the columns of the PBIs (no tasks, nothing removed) for the group-bys
+    category_lookup, fallback_lookup = export._compile_state_categories(state_categories)
+    planned_column = None
+    if 'Excel.Planned' in tag_classifier.column_names:
+        planned_column = tag_classifier.column_names.index('Excel.Planned')
+
+    path_column = []
+    completed_column = []
+    value_column = []
+    lead_column = []
+    unplanned_column = []
+    work_column = []
+    for iteration_path, work_item_type, state, business_value, start_seconds, finish_seconds, \
+            tags, planned, completed_work in pbi_rows:
+        if work_item_type == 'Task':
+            continue
+        category = category_lookup.get(work_item_type, fallback_lookup).get(state, export.UNCATEGORIZED)
+        if category == export.REMOVED:
+            continue
+        if planned is None and tags is not None and planned_column is not None:
+            # the first exports left the column empty
+            planned = tag_classifier.classify(tags)[planned_column]
+        completed = category == export.COMPLETED
+        path_column.append(iteration_path)
+        completed_column.append(completed)
+        value_column.append((business_value or 0.0) if completed else 0.0)
+        lead_column.append((finish_seconds - start_seconds) / export.SECONDS_PER_DAY
+            if completed and start_seconds is not None and finish_seconds is not None else None)
+        unplanned_column.append(planned == 'Unplanned')
+        work_column.append(completed_work)
+    return path_column, completed_column, value_column, lead_column, unplanned_column, work_column
+
+
+def _group_python(iteration_path_list, path_column, completed_column, value_column, lead_column,
+        unplanned_column, work_column):
+    group_index = dict((iteration_path, group) for group, iteration_path in enumerate(iteration_path_list))
+    group_count = len(iteration_path_list)
+    items = [0] * group_count
+    throughput = [0] * group_count
+    velocity = [0.0] * group_count
+    unplanned = [0] * group_count
+    completed_work = [None] * group_count
+    lead_times = [[] for group in range(group_count)]
+    for row in range(len(path_column)):
+        group = group_index[path_column[row]]
+        items[group] += 1
+        throughput[group] += completed_column[row]
+        velocity[group] += value_column[row]
+        unplanned[group] += unplanned_column[row]
+        if work_column[row] is not None:
+            completed_work[group] = (completed_work[group] or 0.0) + work_column[row]
+        if lead_column[row] is not None:
+            lead_times[group].append(lead_column[row])
+    lead_time_percentiles = [_percentiles(sorted(lead_list), LEAD_TIME_PERCENTILES) if len(lead_list) > 0 else None
+        for lead_list in lead_times]
+    return items, throughput, velocity, unplanned, completed_work, lead_time_percentiles
+
+
+def _group_numpy(numpy, iteration_path_list, path_column, completed_column, value_column, lead_column,
+        unplanned_column, work_column):
+    group_index = dict((iteration_path, group) for group, iteration_path in enumerate(iteration_path_list))
+    group_count = len(iteration_path_list)
+    groups = numpy.array([group_index[iteration_path] for iteration_path in path_column], dtype=numpy.int64)
+    completed = numpy.array(completed_column, dtype=bool)
+
+    items = numpy.bincount(groups, minlength=group_count)
+    throughput = numpy.bincount(groups, weights=completed, minlength=group_count)
+    velocity = numpy.bincount(groups, weights=numpy.array(value_column, dtype=float), minlength=group_count)
+    unplanned = numpy.bincount(groups, weights=numpy.array(unplanned_column, dtype=bool), minlength=group_count)
+
+    work = numpy.array([numpy.nan if value is None else value for value in work_column], dtype=float)
+    has_work = ~numpy.isnan(work)
+    completed_work = numpy.bincount(groups[has_work], weights=work[has_work], minlength=group_count).tolist()
+    work_groups = numpy.bincount(groups[has_work], minlength=group_count) > 0
+
+    # sort the lead times by sprint, then each sprint is a slice
+    lead = numpy.array([numpy.nan if value is None else value for value in lead_column], dtype=float)
+    has_lead = ~numpy.isnan(lead)
+    lead_groups = groups[has_lead]
+    lead = lead[has_lead]
+    order = numpy.lexsort((lead, lead_groups))
+    lead_groups = lead_groups[order]
+    lead = lead[order]
+    bounds = numpy.searchsorted(lead_groups, numpy.arange(group_count + 1))
+    lead_time_percentiles = [numpy.percentile(lead[bounds[group]:bounds[group + 1]], LEAD_TIME_PERCENTILES).tolist()
+        if bounds[group + 1] > bounds[group] else None for group in range(group_count)]
+
+    return items.tolist(), [int(count) for count in throughput.tolist()], velocity.tolist(), \
+        [int(count) for count in unplanned.tolist()], \
+        [completed_work[group] if work_groups[group] else None for group in range(group_count)], \
+        lead_time_percentiles
+
+
+def compute_sprint_metrics(iteration_path_list, pbi_rows, capacity_rows, state_categories=None, tag_classifier=None):
+    # {iteration path: {metric: value}} of sprint_metric_names
+    if state_categories is None:
+        state_categories = export.work_item_state_categories
+    if tag_classifier is None:
+        tag_classifier = export.tag_classifier
+
+    columns = _pbi_columns(pbi_rows, state_categories, tag_classifier)
+    numpy = export._import_numpy()
+    if numpy is not None and len(columns[0]) > 0:
+        items, throughput, velocity, unplanned, completed_work, lead_time_percentiles = \
+            _group_numpy(numpy, iteration_path_list, *columns)
+    else:
+        items, throughput, velocity, unplanned, completed_work, lead_time_percentiles = \
+            _group_python(iteration_path_list, *columns)
+
+    # a few members per sprint, added up as they come
+    capacity_hours = dict((iteration_path, None) for iteration_path in iteration_path_list)
+    for iteration_path, capacity_per_day, days_per_iteration in capacity_rows:
+        capacity_hours[iteration_path] = (capacity_hours[iteration_path] or 0.0) + \
+            (capacity_per_day or 0.0) * (days_per_iteration or 0.0)
+
+    sprint_metrics = {}
+    for group, iteration_path in enumerate(iteration_path_list):
+        metrics = {
+            'items': items[group],
+            'throughput': throughput[group],
+            'velocity': velocity[group],
+            'planned': items[group] - unplanned[group],
+            'unplanned': unplanned[group],
+            'unplanned_ratio': unplanned[group] / float(items[group]) if items[group] > 0 else None,
+            'capacity_hours': capacity_hours[iteration_path],
+            'completed_work': completed_work[group],
+            'utilisation': completed_work[group] / capacity_hours[iteration_path]
+                if completed_work[group] is not None and capacity_hours[iteration_path] else None
+        }
+        for p, percentile in enumerate(LEAD_TIME_PERCENTILES):
+            metrics['lead_time_p{0}'.format(percentile)] = \
+                None if lead_time_percentiles[group] is None else lead_time_percentiles[group][p]
+        sprint_metrics[iteration_path] = metrics
+    return sprint_metrics
+
+
+def _format_metric(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return "{0:.2f}".format(value)
+    return str(value)
+
+
+def print_report(report_rows):
+    print("{0:<32} ".format('IterationPath') + ' '.join(["{0:>15}".format(metric_name) for metric_name in sprint_metric_names]))
+    for iteration_path, metrics in report_rows:
+        print("{0:<32} ".format(iteration_path) + ' '.join(["{0:>15}".format(_format_metric(metrics.get(metric_name)))
+            for metric_name in sprint_metric_names]))
+
+
+def save_report(report_rows, file_path):
+    if file_path.endswith('.json'):
+        with open(file_path, 'w') as report_file:
+            json.dump(dict(report_rows), report_file, indent=2)
+    else:
+        with open(file_path, 'w', newline='', encoding='utf-8') as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(['IterationPath'] + sprint_metric_names)
+            for iteration_path, metrics in report_rows:
+                writer.writerow([iteration_path] + [metrics.get(metric_name) for metric_name in sprint_metric_names])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Report the sprint metrics of the exports in a folder.')
+    parser.add_argument('-d', '--folder', metavar='<Export Folder>', default='iterations',
+                        help='folder of the PBI and capacity exports (default: iterations)')
+    parser.add_argument('--store', metavar='<SQLite File>',
+                        help='where the exports and metrics are kept between reports (default: {0})'.format(
+                            os.path.join(export.CACHE_FOLDER, ANALYTICS_FILE_NAME)))
+    parser.add_argument('-o', '--output', metavar='<Report File>',
+                        help='save the report as csv, or as json when the name ends in .json')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='ingest every export again and recompute all sprints')
+    parser.add_argument('--state-categories', metavar='<JSON File>',
+                        help='categories of the process states per work item type, see ListWorkItemsForIteration.py')
+    parser.add_argument('--tag-rules', metavar='<JSON File>',
+                        help='rules of the columns derived from the tags, see ListWorkItemsForIteration.py')
+
+    args = parser.parse_args()
+
+    state_categories = export.work_item_state_categories
+    if args.state_categories is not None:
+        state_categories = export.load_state_categories(args.state_categories)
+    tag_rules = export.tag_classification_rules
+    if args.tag_rules is not None:
+        tag_rules = export.load_tag_rules(args.tag_rules)
+    tag_classifier = export.TagClassifier(tag_rules)
+
+    store_path = args.store
+    if store_path is None:
+        store_path = os.path.join(export.CACHE_FOLDER, ANALYTICS_FILE_NAME)
+    if args.rebuild and os.path.exists(store_path):
+        os.remove(store_path)
+    store = AnalyticsStore(store_path)
+    store.use_settings({'state_categories': state_categories, 'tag_rules': tag_rules,
+        'lead_time_percentiles': LEAD_TIME_PERCENTILES})
+
+    # only the exports written since the last report are read again
+    source_list = _export_sources(args.folder)
+    known_sources = store.sources()
+    for source in set(known_sources) - set([file_path for file_path, export_format in source_list]):
+        print("****** Forgetting {0} ....".format(source))
+        store.forget(source)
+    changed_source_list = [(file_path, export_format, _source_signature(file_path))
+        for file_path, export_format in source_list]
+    changed_source_list = [source for source in changed_source_list if known_sources.get(source[0]) != source[2]]
+    print("****** Ingesting {0} of {1} exports ....".format(len(changed_source_list), len(source_list)))
+    for file_path, export_format, signature in changed_source_list:
+        iteration_path_set, row_count = store.ingest(file_path, export_format, signature)
+        print("{0}: {1} rows, {2} sprints".format(file_path, row_count, len(iteration_path_set)))
+
+    stale_iteration_path_list = store.stale_iteration_paths()
+    print("****** Computing the metrics of {0} sprints ....".format(len(stale_iteration_path_list)))
+    if len(stale_iteration_path_list) > 0:
+        store.save_metrics(compute_sprint_metrics(stale_iteration_path_list,
+            store.pbi_rows(stale_iteration_path_list), store.capacity_rows(stale_iteration_path_list),
+            state_categories, tag_classifier))
+
+    report_rows = store.all_metrics()
+    store.close()
+
+    print_report(report_rows)
+    if args.output is not None:
+        print("****** Saving the report to {0} ....".format(args.output))
+        save_report(report_rows, args.output)
+
+    print("****** Completed")
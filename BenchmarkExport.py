@@ -0,0 +1,291 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+from azure.devops.v5_1.work import models as workModels
+from openpyxl import Workbook
+
+import ListWorkItemsForIteration as export
+
+# synthetic sprints start on this day, two weeks each
+FIRST_SPRINT_START = datetime(2021, 1, 4, tzinfo=pytz.utc)
+TEAM_MEMBER_COUNT = 8
+# a stage is slower than the baseline only when it is behind by this much as
+# well, the fastest stages take milliseconds and vary more than any tolerance
+BASELINE_MIN_SLOWDOWN_SECONDS = 0.05
+
+
+def _iso(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _field_update(old_value, new_value):
+    return {'old_value': old_value, 'new_value': new_value}
+
+
+def generate_fixtures(team_context, work_item_count, iteration_count):
+    # a FixtureStore with iteration_count sprints sharing work_item_count
+    # PBIs, their revisions and the team capacities, shaped like the
+    # recorded DevOps responses
+    store = export.FixtureStore()
+    tag_choices = ['Electric; INOH', 'Gas', 'Gas; Unplanned', 'GIS', '']
+    state_path = ['New', 'Approved', 'Committed', 'Started', 'Done']
+
+    iteration_list = []
+    for k in range(iteration_count):
+        start_date = FIRST_SPRINT_START + timedelta(days=14 * k)
+        iteration_list.append({
+            'id': "iteration-{0}".format(k),
+            'name': "Sprint {0}".format(k + 1),
+            'path': "{0}\\Sprint {1}".format(team_context.project, k + 1),
+            'attributes': {'start_date': _iso(start_date),
+                'finish_date': _iso(start_date + timedelta(days=13)), 'time_frame': 'past'}
+        })
+    store.put('get_team_iterations', export._team_key(team_context, None), iteration_list)
+
+    items_per_iteration = max(1, work_item_count // max(1, iteration_count))
+    item_id = 0
+    for k in range(iteration_count):
+        iteration = iteration_list[k]
+        start_date = FIRST_SPRINT_START + timedelta(days=14 * k)
+        id_list = []
+        last_count = work_item_count - item_id if k == iteration_count - 1 else items_per_iteration
+        for n in range(last_count):
+            item_id += 1
+            id_list.append(item_id)
+            # walk the item through the states, one revision a day
+            update_list = []
+            changed_date = start_date
+            for rev in range(len(state_path)):
+                changed_date = start_date + timedelta(days=rev, hours=item_id % 9)
+                update_list.append({'id': rev + 1, 'rev': rev + 1, 'fields': {
+                    'System.State': _field_update(state_path[rev - 1] if rev > 0 else None, state_path[rev]),
+                    'System.ChangedDate': _field_update(None, _iso(changed_date)),
+                    'System.IterationPath': _field_update(None, iteration['path'])
+                }})
+            store.put('get_updates', str(item_id), update_list)
+            store.put('get_work_items', str(item_id), {'id': item_id, 'rev': len(update_list), 'fields': {
+                'System.Id': item_id,
+                'System.WorkItemType': 'Product Backlog Item',
+                'System.Title': "Work item {0}".format(item_id),
+                'System.Tags': tag_choices[item_id % len(tag_choices)],
+                'Microsoft.VSTS.Common.ValueArea': 'Business',
+                'Microsoft.VSTS.Common.BusinessValue': item_id % 100,
+                'System.AssignedTo': {'displayName': "Developer {0}".format(item_id % TEAM_MEMBER_COUNT)},
+                'System.State': state_path[-1],
+                'System.CreatedDate': _iso(start_date),
+                'System.ChangedDate': _iso(changed_date),
+                'System.AreaPath': team_context.project,
+                'System.IterationPath': iteration['path']
+            }})
+        query = export.compose_wiql(export.pbi_wiql_template, team_context, iteration['path'])
+        store.put('query_by_wiql', export._query_key(query), id_list)
+
+        store.put('get_capacities_with_identity_ref', export._team_key(team_context, iteration['id']), [{
+            'team_member': {'display_name': "Developer {0}".format(m)},
+            'activities': [{'name': 'Development', 'capacity_per_day': 6.0}],
+            'days_off': [{'start': _iso(start_date + timedelta(days=2)),
+                'end': _iso(start_date + timedelta(days=2))}] if m % 4 == 0 else []
+        } for m in range(TEAM_MEMBER_COUNT)])
+        store.put('get_team_days_off', export._team_key(team_context, iteration['id']), {'days_off': []})
+
+    return store
+
+
+def report(stage, seconds, count, unit='rows'):
+    print("{0:<24} {1:>8.3f}s {2:>10,} {3:<12} {4:>12,.0f} {3}/s".format(
+        stage, seconds, count, unit, count / seconds if seconds > 0 else 0))
+
+
+@contextlib.contextmanager
+def timed(stage, results, unit='rows'):
+    # the stages print per item, keep that off the report
+    counter = {'count': 0}
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield counter
+    seconds = time.perf_counter() - start
+    results.append((stage, seconds, counter['count'], unit))
+    report(stage, seconds, counter['count'], unit)
+
+
+def benchmark_stages(team_context, max_workers, export_formats):
+    # the export stages of ListWorkItemsForIteration over all the
+    # iterations served by export.connection
+    results = []
+
+    iteration_index = export.TeamIterationIndex(team_context)
+    iteration_list = iteration_index.started()
+    work_tracking_client = export.connection.clients.get_work_item_tracking_client()
+
+    with timed('query', results, 'ids') as counter:
+        for iteration in iteration_list:
+            query = export.compose_wiql(export.pbi_wiql_template, team_context, iteration['iteration_path'])
+            response = work_tracking_client.query_by_wiql(
+                export.workItemTrackingModels.Wiql(query=query), team_context)
+            counter['count'] += len(response.work_items)
+
+    work_items_by_iteration = []
+    with timed('fetch', results, 'items') as counter:
+        for iteration in iteration_list:
+            work_item_list = export.retrieve_PBIs(team_context, iteration['iteration_path'], None, max_workers)
+            work_items_by_iteration.append(work_item_list)
+            counter['count'] += len(work_item_list)
+
+    revision_histories_by_iteration = []
+    with timed('revisions', results, 'items') as counter:
+        for work_item_list in work_items_by_iteration:
+            revision_histories = export.get_revision_histories(team_context, work_item_list, max_workers)
+            revision_histories_by_iteration.append(revision_histories)
+            counter['count'] += len(revision_histories)
+
+    lead_durations_by_iteration = []
+    with timed('flow metrics', results, 'items') as counter:
+        for work_item_list, revision_histories in zip(work_items_by_iteration, revision_histories_by_iteration):
+            flow_metrics = export.compute_flow_metrics(work_item_list, revision_histories)
+            lead_durations_by_iteration.append(dict((item_id, export._lead_duration(metrics))
+                for item_id, metrics in flow_metrics.items()))
+            counter['count'] += len(flow_metrics)
+
+    with timed('capacities', results, 'members') as counter:
+        capacities_by_iteration = export.get_team_capacities([iteration_index],
+            [iteration['iteration_path'] for iteration in iteration_list], max_workers)
+        counter['count'] = sum([len(capacity_list) for capacity_list in capacities_by_iteration.values()])
+
+    with tempfile.TemporaryDirectory() as output_folder:
+        for export_format in export_formats:
+            with timed("write {0}".format(export_format), results) as counter:
+                writer = export.open_export_writer(
+                    os.path.join(output_folder, "benchmark_PBI." + export_format), 'current_iteration', export_format)
+                for iteration, work_item_list, lead_durations in zip(
+                        iteration_list, work_items_by_iteration, lead_durations_by_iteration):
+                    writer.write_pbi(work_item_list, iteration['iteration_due_date'], lead_durations, team_context)
+                    counter['count'] += len(work_item_list)
+                writer.close()
+
+    return results, [work_item for work_item_list in work_items_by_iteration for work_item in work_item_list]
+
+
+def benchmark_row_projection(work_item_list, team_context, results):
+    lead_durations = dict((work_item.id, ('2021-01-05T15:00:00Z', '2021-01-14T15:00:00Z'))
+        for work_item in work_item_list)
+
+    with timed('classify tags', results) as counter:
+        tag_classifier = export.TagClassifier(export.tag_classification_rules)
+        tag_classifier.classify_batch([work_item.get('System.Tags', '') for work_item in work_item_list])
+        counter['count'] = len(work_item_list)
+
+    with timed('project PBI rows', results) as counter:
+        row_plan = export.compile_pbi_row_plan(team_context, datetime.now())
+        for row in export.project_pbi_rows(work_item_list, row_plan, lead_durations):
+            counter['count'] += 1
+
+    with tempfile.TemporaryDirectory() as output_folder:
+        with timed('write PBI workbook', results) as counter:
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet('current_iteration')
+            export.write_pbi_to_workbook(work_item_list, ws, datetime.now(), False, lead_durations, team_context)
+            wb.save(os.path.join(output_folder, 'benchmark_PBI.xlsx'))
+            counter['count'] = len(work_item_list)
+
+
+def save_results(file_path, results, settings):
+    # the timings of a run, to compare later runs against with --baseline
+    with open(file_path, 'w') as results_file:
+        json.dump({'settings': settings, 'stages': dict((stage, {'seconds': seconds, 'count': count, 'unit': unit})
+            for stage, seconds, count, unit in results)}, results_file, indent=2)
+
+
+def compare_with_baseline(file_path, results, settings, tolerance):
+    # the stages more than tolerance (a fraction) slower than in the saved
+    # baseline. the timings are only comparable on the same workload
+    with open(file_path, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline['settings'] != settings:
+        raise Exception("The baseline {0} was measured with other settings ({1}).".format(file_path, baseline['settings']))
+
+    slower_stages = []
+    for stage, seconds, count, unit in results:
+        if stage not in baseline['stages']:
+            print("{0:<24} {1:>8.3f}s    not in the baseline".format(stage, seconds))
+            continue
+        baseline_seconds = baseline['stages'][stage]['seconds']
+        allowed_seconds = max(baseline_seconds * (1 + tolerance), baseline_seconds + BASELINE_MIN_SLOWDOWN_SECONDS)
+        slower = seconds > allowed_seconds
+        if slower:
+            slower_stages.append(stage)
+        print("{0:<24} {1:>8.3f}s {2:>8.3f}s {3:>+7.1%} {4}".format(stage, seconds, baseline_seconds,
+            seconds / baseline_seconds - 1 if baseline_seconds > 0 else 0, "SLOWER" if slower else "ok"))
+    return slower_stages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the export stages offline, on synthetic or recorded DevOps responses.')
+    parser.add_argument('-p', '--project', metavar='<Project Name>', default='CNP.GIS',
+                        help='ex. CNP.GIS')
+    parser.add_argument('-t', '--team', metavar='<Team Name>', default='CNP.GIS Team',
+                        help='ex. CNP.GIS Team')
+    parser.add_argument('-n', '--count', metavar='<Work Item Count>', type=int, default=20000,
+                        help='number of synthetic work items (default: 20000)')
+    parser.add_argument('--iterations', metavar='<Iteration Count>', type=int, default=20,
+                        help='number of synthetic iterations (default: 20)')
+    parser.add_argument('-w', '--workers', metavar='<Worker Count>', type=int, default=export.MAX_WORKERS,
+                        help='concurrent requests (default: {0})'.format(export.MAX_WORKERS))
+    parser.add_argument('--latency', metavar='<Milliseconds>', type=float, default=0,
+                        help='delay added to every replayed call, standing for the network (default: 0)')
+    parser.add_argument('-f', '--format', choices=export.EXPORT_FORMATS, action='append',
+                        help='formats written in the write stage, repeatable (default: xlsx and csv)')
+    parser.add_argument('--replay', metavar='<Fixture Folder>',
+                        help='use responses recorded with ListWorkItemsForIteration.py --record instead of synthetic ones')
+    parser.add_argument('--save-fixtures', metavar='<Fixture Folder>',
+                        help='save the synthetic responses for ListWorkItemsForIteration.py --replay')
+    parser.add_argument('--save-results', metavar='<Results File>',
+                        help='save the timings as json, to be used as a --baseline')
+    parser.add_argument('--baseline', metavar='<Results File>',
+                        help='compare with timings saved by --save-results, exit with 1 when a stage got slower')
+    parser.add_argument('--tolerance', metavar='<Fraction>', type=float, default=0.2,
+                        help='how much slower than the baseline a stage may be (default: 0.2, i.e. 20%%)')
+
+    args = parser.parse_args()
+
+    team_context = workModels.TeamContext(project=args.project, team=args.team)
+
+    if args.replay is not None:
+        print("****** Loading the recorded responses from {0} ....".format(args.replay))
+        store = export.FixtureStore(args.replay)
+    else:
+        print("****** Generating {0} work items in {1} iterations ....".format(args.count, args.iterations))
+        store = generate_fixtures(team_context, args.count, args.iterations)
+        if args.save_fixtures is not None:
+            store.save(args.save_fixtures)
+
+    # no network from here on, nor a request rate to keep under
+    export.connection = export.DevOpsSession(replay_store=store, replay_latency_seconds=args.latency / 1000.0)
+    export.request_scheduler = export.RequestScheduler(0, export.REQUEST_BURST, args.workers, args.workers)
+
+    print("****** Timing the export stages ....")
+    results, work_item_list = benchmark_stages(team_context, args.workers, args.format or ['xlsx', 'csv'])
+
+    print("****** Timing the row projection ....")
+    benchmark_row_projection(work_item_list, team_context, results)
+
+    # the workload the timings depend on
+    settings = {'replay': args.replay, 'count': args.count, 'iterations': args.iterations,
+        'workers': args.workers, 'latency': args.latency}
+
+    if args.save_results is not None:
+        print("****** Saving the timings to {0} ....".format(args.save_results))
+        save_results(args.save_results, results, settings)
+
+    if args.baseline is not None:
+        print("****** Comparing with the baseline {0} ....".format(args.baseline))
+        slower_stages = compare_with_baseline(args.baseline, results, settings, args.tolerance)
+        if len(slower_stages) > 0:
+            print("****** {0} stage(s) slower than the baseline: {1}".format(len(slower_stages), ", ".join(slower_stages)))
+            sys.exit(1)
@@ -1,14 +1,31 @@
 import argparse
-import copy
+import contextlib
+import csv
+import io
+import json
 import os
-from datetime import datetime
+import queue
+import random
+import re
+import shutil
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytz
-from azure.devops.connection import Connection
+from azure.devops.exceptions import AzureDevOpsClientRequestError
 from azure.devops.v5_1.work import models as workModels
 from azure.devops.v5_1.work_item_tracking import \
     models as workItemTrackingModels
-from msrest.authentication import BasicAuthentication
 from openpyxl import Workbook
 from openpyxl import load_workbook
 
@@ -20,9 +37,262 @@ organization_url = 'https://dev.azure.com/CenterPoint-GIS'
 usa_cst = pytz.timezone('US/Central')
 today_timezone = usa_cst.localize(datetime.now())
 
-# Create a connection to the org
-credentials = BasicAuthentication('', personal_access_token)
-connection = Connection(base_url=organization_url, creds=credentials)
+# the DevOps calls captured by --record and served by --replay
+RECORDED_METHODS = ['query_by_wiql', 'get_work_items', 'get_updates', 
+    'get_team_iterations', 'get_capacities_with_identity_ref', 'get_team_days_off']
+
+
+def _team_key(team_context, *values): 
+    return '/'.join([team_context.project, team_context.team] + [str(value) for value in values])
+
+
+def _query_key(query, time_precision=None): 
+    return "{0}|{1}".format(' '.join(query.split()), time_precision)
+
+
+def _work_item_updates_from_dicts(update_list): 
+    # build the models directly, msrest from_dict is slow on long histories
+    return [workItemTrackingModels.WorkItemUpdate(id=update.get('id'), rev=update.get('rev'), 
+        fields=None if update.get('fields') is None else dict(
+            (field_name, workItemTrackingModels.WorkItemFieldUpdate(
+                old_value=field_update.get('old_value'), new_value=field_update.get('new_value'))) 
+            for field_name, field_update in update['fields'].items())) 
+        for update in update_list]
+
+
+class FixtureStore: 
+    # recorded DevOps responses as plain dicts, one json file per method
+    # mapping a call key to its response. work items and revisions are 
+    # recorded per id so any batching can be replayed.
+
+    def __init__(self, folder=None): 
+        self.folder = folder
+        self._responses = dict((method_name, {}) for method_name in RECORDED_METHODS)
+        self._lock = threading.Lock()
+        if folder is not None: 
+            for method_name in RECORDED_METHODS: 
+                file_path = os.path.join(folder, method_name + '.json')
+                if os.path.exists(file_path): 
+                    with open(file_path, 'r') as fixture_file: 
+                        self._responses[method_name] = json.load(fixture_file)
+
+    def get(self, method_name, key): 
+        response = self._responses[method_name].get(key)
+        if response is None: 
+            raise Exception("No recorded response for {0} ({1}).".format(method_name, key))
+        return response
+
+    def put(self, method_name, key, response): 
+        with self._lock: 
+            self._responses[method_name][key] = response
+
+    def save(self, folder=None): 
+        if folder is None: 
+            folder = self.folder
+        if not os.path.exists(folder): 
+            os.makedirs(folder)
+        with self._lock: 
+            for method_name in RECORDED_METHODS: 
+                with open(os.path.join(folder, method_name + '.json'), 'w') as fixture_file: 
+                    json.dump(self._responses[method_name], fixture_file)
+
+
+class RecordingClient: 
+    # passes the calls through to a DevOps client and records the responses
+
+    def __init__(self, client, store): 
+        self._client = client
+        self._store = store
+
+    def __getattr__(self, name): 
+        # the calls not recorded
+        return getattr(self._client, name)
+
+    def query_by_wiql(self, wiql, team_context=None, time_precision=None, top=None): 
+        response = self._client.query_by_wiql(wiql, team_context, time_precision=time_precision, top=top)
+        if response is not None: 
+            self._store.put('query_by_wiql', _query_key(wiql.query, time_precision), 
+                [work_item_id.id for work_item_id in response.work_items])
+        return response
+
+    def get_work_items(self, ids, project=None, fields=None, as_of=None, expand=None, error_policy=None): 
+        response = self._client.get_work_items(ids, project=project, fields=fields, 
+            as_of=as_of, expand=expand, error_policy=error_policy)
+        if response is not None: 
+            for work_item in response: 
+                if work_item is not None: 
+                    self._store.put('get_work_items', str(work_item.id), 
+                        {'id': work_item.id, 'rev': work_item.rev, 'fields': work_item.fields})
+        return response
+
+    def get_updates(self, id, project=None, top=None, skip=None): 
+        response = self._client.get_updates(id, project=project, top=top, skip=skip)
+        if response is not None: 
+            self._store.put('get_updates', str(id), [update.as_dict() for update in response])
+        return response
+
+    def get_team_iterations(self, team_context, timeframe=None): 
+        response = self._client.get_team_iterations(team_context, timeframe)
+        if response is not None: 
+            self._store.put('get_team_iterations', _team_key(team_context, timeframe), 
+                [iteration.as_dict() for iteration in response])
+        return response
+
+    def get_capacities_with_identity_ref(self, team_context, iteration_id): 
+        response = self._client.get_capacities_with_identity_ref(team_context, iteration_id)
+        if response is not None: 
+            self._store.put('get_capacities_with_identity_ref', _team_key(team_context, iteration_id), 
+                [capacity.as_dict() for capacity in response])
+        return response
+
+    def get_team_days_off(self, team_context, iteration_id): 
+        response = self._client.get_team_days_off(team_context, iteration_id)
+        if response is not None: 
+            self._store.put('get_team_days_off', _team_key(team_context, iteration_id), response.as_dict())
+        return response
+
+
+class ReplayClient: 
+    # serves the recorded responses of a FixtureStore in place of both the 
+    # work and the work item tracking clients, optionally after a delay that
+    # stands for the network latency
+
+    def __init__(self, store, latency_seconds=0): 
+        self._store = store
+        self.latency_seconds = latency_seconds
+
+    def _get(self, method_name, key): 
+        if self.latency_seconds > 0: 
+            time.sleep(self.latency_seconds)
+        return self._store.get(method_name, key)
+
+    def query_by_wiql(self, wiql, team_context=None, time_precision=None, top=None): 
+        id_list = self._get('query_by_wiql', _query_key(wiql.query, time_precision))
+        if top is not None: 
+            id_list = id_list[:top]
+        return workItemTrackingModels.WorkItemQueryResult(
+            work_items=[workItemTrackingModels.WorkItemReference(id=item_id) for item_id in id_list])
+
+    def get_work_items(self, ids, project=None, fields=None, as_of=None, expand=None, error_policy=None): 
+        if self.latency_seconds > 0: 
+            time.sleep(self.latency_seconds)
+        work_item_list = []
+        for item_id in ids: 
+            work_item = self._store.get('get_work_items', str(item_id))
+            item_fields = work_item['fields']
+            if fields is not None: 
+                item_fields = dict((field_name, item_fields[field_name]) 
+                    for field_name in fields if field_name in item_fields)
+            work_item_list.append(workItemTrackingModels.WorkItem(
+                id=work_item['id'], rev=work_item['rev'], fields=item_fields))
+        return work_item_list
+
+    def get_updates(self, id, project=None, top=None, skip=None): 
+        update_list = self._get('get_updates', str(id))
+        if skip is not None: 
+            update_list = update_list[skip:]
+        if top is not None: 
+            update_list = update_list[:top]
+        return _work_item_updates_from_dicts(update_list)
+
+    def get_team_iterations(self, team_context, timeframe=None): 
+        return [workModels.TeamSettingsIteration.from_dict(iteration) 
+            for iteration in self._get('get_team_iterations', _team_key(team_context, timeframe))]
+
+    def get_capacities_with_identity_ref(self, team_context, iteration_id): 
+        return [workModels.TeamMemberCapacityIdentityRef.from_dict(capacity) for capacity in 
+            self._get('get_capacities_with_identity_ref', _team_key(team_context, iteration_id))]
+
+    def get_team_days_off(self, team_context, iteration_id): 
+        return workModels.TeamSettingsDaysOff.from_dict(
+            self._get('get_team_days_off', _team_key(team_context, iteration_id)))
+
+
+class _SharedHttpSession: 
+    # in place of the threading.local holding the session of an msrest sender
+
+    def __init__(self, session): 
+        self.session = session
+
+
+class DevOpsSession: 
+    # stands in for the azure.devops Connection. the connection and each client
+    # are created on first use, so importing this module does no auth or 
+    # network work. the clients are created once and share one requests 
+    # session, whose pool keeps the HTTP connections alive for all threads 
+    # instead of a new handshake per call (or per thread). with a 
+    # record_store the responses are recorded, with a replay_store they are
+    # served from it without any connection.
+
+    def __init__(self, base_url=organization_url, access_token=personal_access_token, 
+            record_store=None, replay_store=None, replay_latency_seconds=0): 
+        self.base_url = base_url
+        self.access_token = access_token
+        self.record_store = record_store
+        self.replay_store = replay_store
+        self.replay_latency_seconds = replay_latency_seconds
+        self._connection = None
+        self._http_session = None
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @property
+    def clients(self): 
+        # connection.clients.get_..._client() as with the SDK connection
+        return self
+
+    def _get_connection(self): 
+        if self._connection is None: 
+            from azure.devops.connection import Connection
+            from msrest.authentication import BasicAuthentication
+
+            # Create a connection to the org
+            credentials = BasicAuthentication('', self.access_token)
+            self._connection = Connection(base_url=self.base_url, creds=credentials)
+        return self._connection
+
+    def _get_client(self, client_name): 
+        with self._lock: 
+            if client_name not in self._clients: 
+                if self.replay_store is not None: 
+                    client = ReplayClient(self.replay_store, self.replay_latency_seconds)
+                else: 
+                    client = getattr(self._get_connection().clients, client_name)()
+                    # reuse the pooled connections of the requests session
+                    client.config.keep_alive = True
+                    self._share_http_session(client)
+                    # let the scheduler see the rate limit headers
+                    request_scheduler.watch(client)
+                    if self.record_store is not None: 
+                        client = RecordingClient(client, self.record_store)
+                self._clients[client_name] = client
+            return self._clients[client_name]
+
+    def _share_http_session(self, client): 
+        # msrest keeps a requests session per thread, so every worker thread
+        # would open its own connections. all the clients and threads use 
+        # this one instead, its pool holds a connection per concurrent call
+        driver = client.config.pipeline._sender.driver
+        if self._http_session is None: 
+            import requests
+            self._http_session = requests.Session()
+            pool_size = max(MAX_CONCURRENT_REQUESTS, request_scheduler.max_concurrency)
+            for protocol in ['https://', 'http://']: 
+                self._http_session.mount(protocol, requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+            driver._init_session(self._http_session)
+        driver._session_mapping = _SharedHttpSession(self._http_session)
+
+    def get_core_client(self): 
+        return self._get_client('get_core_client')
+
+    def get_work_client(self): 
+        return self._get_client('get_work_client')
+
+    def get_work_item_tracking_client(self): 
+        return self._get_client('get_work_item_tracking_client')
+
+
+connection = DevOpsSession()
 
 class experiment: 
     def get_projects():
@@ -72,254 +342,1533 @@ class experiment:
 
 work_item_type_of_interest = ["Product Backlog Item", "Task"]
 
+# the {Parameters} of the templates are filled in by build_wiql, quoted and escaped
 pbi_wiql_template = "\
     Select [System.Id] From WorkItems \
-    Where [System.AreaPath] = '{AreaPath}' \
+    Where [System.AreaPath] {AreaOperator} {AreaPath} \
         and [System.WorkItemType] in ('Product Backlog Item') \
         and [System.State] <> 'Removed' \
-        and [System.IterationPath] = '{IterationPath}' \
+        and [System.IterationPath] = {IterationPath} \
     Order by [Microsoft.VSTS.Common.Priority] asc, [System.CreatedDate] desc \
 "
 
 task_wiql_template = "\
     Select [System.Id] From WorkItems \
-    Where [System.AreaPath] = '{AreaPath}' \
+    Where [System.AreaPath] {AreaOperator} {AreaPath} \
         and [System.WorkItemType] in ('Task') \
         and [System.State] <> 'Removed' \
-        and [System.IterationPath] = '{IterationPath}' \
+        and [System.IterationPath] = {IterationPath} \
+    Order by [Microsoft.VSTS.Common.Priority] asc, [System.CreatedDate] desc \
+"
+
+# the PBIs and their child Tasks in one query, see retrieve_PBIs_with_tasks
+hierarchy_wiql_template = "\
+    Select [System.Id] From WorkItems \
+    Where [System.AreaPath] {AreaOperator} {AreaPath} \
+        and [System.WorkItemType] in ('Product Backlog Item', 'Task') \
+        and [System.State] <> 'Removed' \
+        and [System.IterationPath] = {IterationPath} \
     Order by [Microsoft.VSTS.Common.Priority] asc, [System.CreatedDate] desc \
 "
 
+# the work items changed since the last --delta export, in any iteration
+delta_wiql_template = "\
+    Select [System.Id] From WorkItems \
+    Where [System.AreaPath] {AreaOperator} {AreaPath} \
+        and [System.WorkItemType] in ({WorkItemTypes}) \
+        and [System.ChangedDate] > {Watermark} \
+"
+
 pbi_field_names = ['System.Id', 'System.WorkItemType', 'System.Parent', 
     'System.Title', 'System.Tags', # 'System.Description',
     'Microsoft.VSTS.Common.ValueArea', 'Microsoft.VSTS.Common.BusinessValue', 
     'System.AssignedTo', 'System.State', 'System.CreatedDate', 'System.ChangedDate',
     'System.AreaPath', 'System.IterationPath']
 
-# two weeks long 
-DAYS_PER_ITERATION = 10 
+# the task fields rolled up to their PBI
+task_field_names = ['Microsoft.VSTS.Scheduling.RemainingWork', 'Microsoft.VSTS.Scheduling.CompletedWork']
 
-capacity_field_names = ['team_member', 'capacity_per_day', 
-    'days_per_iteration', 'IterationPath']
+# fields downloaded for every work item 
+work_item_field_names = pbi_field_names + task_field_names
 
+# derived columns exported after the PBI fields
+pbi_export_field_names = pbi_field_names + ['Excel.Operation', 'Excel.Region', 'Excel.Planned', 
+    'Excel.ItemUrl', # Item URL to DevOps
+    'Export.Timestamp'] # Export.DueDate
 
-def get_current_iteration(team_context): 
+# roll-ups of the child Tasks, exported after the PBI columns with --tasks
+task_rollup_field_names = ['Rollup.TaskCount', 'Rollup.DoneTaskCount', 
+    'Rollup.RemainingWork', 'Rollup.CompletedWork']
 
-    work_client = connection.clients.get_work_client()
+# the flow metrics of compute_flow_metrics exported with --flow-metrics
+flow_export_field_names = ['Flow.LeadTimeDays', 'Flow.CycleTimeDays', 'Flow.ReopenCount']
+
+# the values kept in memory for each work item, see WorkItemRecord
+record_field_names = work_item_field_names + task_rollup_field_names
+record_field_index = dict((field_name, i) for i, field_name in enumerate(record_field_names))
+
+# fields repeating across the work items, each distinct value is kept once
+interned_field_names = set(['System.WorkItemType', 'System.Tags', 'Microsoft.VSTS.Common.ValueArea', 
+    'System.AssignedTo', 'System.State', 'System.AreaPath', 'System.IterationPath'])
+
+# two weeks long, used when the iteration has no dates 
+DAYS_PER_ITERATION = 10 
+
+capacity_field_names = ['team_member', 'capacity_per_day', 
+    'days_per_iteration', 'IterationPath', 'team']
+
+capacity_export_field_names = capacity_field_names + ['Export.Timestamp'] # Export.DueDate
+
+# formats of the exported files. parquet and arrow are written as datasets 
+# partitioned by IterationPath, one partition per exported iteration
+EXPORT_FORMATS = ['xlsx', 'csv', 'parquet', 'arrow']
+DATASET_FORMATS = ['parquet', 'arrow']
+
+# column types in the parquet and arrow datasets, the other columns are strings
+export_column_types = {
+    'System.Id': 'int64', 
+    'System.Parent': 'int64', 
+    'Microsoft.VSTS.Common.BusinessValue': 'int64', 
+    'System.CreatedDate': 'timestamp', 
+    'System.ChangedDate': 'timestamp', 
+    'capacity_per_day': 'float64', 
+    'days_per_iteration': 'int64', 
+    'Export.Timestamp': 'date', 
+    'Rollup.TaskCount': 'int64', 
+    'Rollup.DoneTaskCount': 'int64', 
+    'Rollup.RemainingWork': 'float64', 
+    'Rollup.CompletedWork': 'float64', 
+    'Flow.LeadTimeDays': 'float64', 
+    'Flow.CycleTimeDays': 'float64', 
+    'Flow.ReopenCount': 'int64'
+}
+
+# category of the process states, per work item type. the lead time runs
+# from the first Proposed state, the cycle time from the first InProgress
+# state, both to the last entry into a Completed state
+STATE_CATEGORIES = ['Proposed', 'InProgress', 'Completed', 'Removed']
+PROPOSED, IN_PROGRESS, COMPLETED, REMOVED = range(len(STATE_CATEGORIES))
+UNCATEGORIZED = -1
+
+work_item_state_categories = {
+    'Product Backlog Item': {'New': 'Proposed', 'Approved': 'Proposed', 'Committed': 'Proposed',
+        'Started': 'InProgress', 'Done': 'Completed', 'Removed': 'Removed'},
+    'Bug': {'New': 'Proposed', 'Approved': 'Proposed', 'Committed': 'Proposed',
+        'Started': 'InProgress', 'Done': 'Completed', 'Removed': 'Removed'},
+    'Task': {'To Do': 'Proposed', 'In Progress': 'InProgress', 'Done': 'Completed', 'Removed': 'Removed'}
+}
+
+SECONDS_PER_DAY = 24 * 3600.0
+
+# the columns derived from System.Tags. the rules of a column are regular 
+# expressions searched in each tag (case-insensitive), the column takes the 
+# value of its first rule matching any tag, or its default
+tag_classification_rules = {
+    'Excel.Operation': {'default': 'Both', 'rules': [
+        {'match': 'ELECTRIC', 'value': 'Electric'}, 
+        {'match': 'GAS', 'value': 'Gas'}]}, 
+    'Excel.Region': {'default': None, 'rules': [
+        {'match': 'INOH', 'value': 'INOH'}]}, 
+    'Excel.Planned': {'default': 'Planned', 'rules': [
+        {'match': 'UNPLANNED', 'value': 'Unplanned'}]}
+}
+
+# concurrent requests against DevOps 
+MAX_WORKERS = 8
+# iterations retrieved at the same time in the ALL mode
+MAX_PARALLEL_ITERATIONS = 4
+# work items per get_work_items call (API maximum)
+WORK_ITEM_BATCH_SIZE = 200
+# work item ids per query_by_wiql call (API maximum), a query matching more 
+# is split into id windows of WIQL_SPLIT_WINDOWS, halved until under the limit
+WIQL_RESULT_LIMIT = 20000
+WIQL_SPLIT_WINDOWS = 4
+# the iterations are exported through a pipeline: the work items go in 
+# chunks to the revision fetches while the next items are fetched, up to 
+# PIPELINE_CHUNKS_IN_FLIGHT chunks ahead, and up to PIPELINE_QUEUE_SIZE 
+# chunks of an iteration wait for the writer before the fetches pause
+PIPELINE_CHUNK_SIZE = WORK_ITEM_BATCH_SIZE
+PIPELINE_CHUNKS_IN_FLIGHT = 2
+PIPELINE_QUEUE_SIZE = 4
+# teams exported at the same time with --batch
+MAX_PARALLEL_TEAMS = 4
+# retry throttled (429) or unavailable (503) requests with exponential backoff
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 1.0
+# every DevOps call goes through the request scheduler: a token bucket of 
+# REQUEST_RATE_PER_SECOND calls (REQUEST_BURST at once) and a concurrency 
+# limit between 1 and MAX_CONCURRENT_REQUESTS, halved on throttling and 
+# raised by one per limit successful calls (AIMD)
+REQUEST_RATE_PER_SECOND = 100.0
+REQUEST_BURST = 20
+MAX_CONCURRENT_REQUESTS = 32
+# back off before the 429 when X-RateLimit-Remaining falls below this 
+# fraction of X-RateLimit-Limit
+RATE_LIMIT_REMAINING_FRACTION = 0.1
+
+# local cache of work items and their revisions
+CACHE_FOLDER = os.path.join('iterations', '.cache')
+CACHE_FILE_NAME = 'devops_cache.sqlite'
+# evict cached entries not used for this many days
+CACHE_MAX_AGE_DAYS = 90
+# the cache file is only vacuumed when this fraction of its pages is free,
+# as VACUUM rewrites the whole file
+CACHE_VACUUM_FREE_FRACTION = 0.25
+
+# the state of the last --delta export is saved next to the PBI output
+DELTA_STATE_SUFFIX = '.delta.json'
+# the changes made while the last export ran are picked up again
+DELTA_WATERMARK_OVERLAP_SECONDS = 300
+
+# upper bounds of the API call latency histograms, in seconds
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+# print every work item and iteration as it is retrieved, see --quiet
+verbose = True
+
+# iterations starting before this year are skipped
+ITERATION_START_YEAR = 2021
+# reuse the team iterations downloaded within this many seconds
+ITERATION_CACHE_TTL_SECONDS = 6 * 3600
+# --daemon refreshes the export this often, and serves it on this host with --port
+DAEMON_REFRESH_SECONDS = 10 * 60
+DAEMON_HOST = '127.0.0.1'
+
+
+def _header_seconds(value): 
+    # Retry-After is seconds or an HTTP date
+    try: 
+        return float(value)
+    except ValueError: 
+        try: 
+            return (parsedate_to_datetime(value) - datetime.now(pytz.utc)).total_seconds()
+        except (TypeError, ValueError): 
+            return None
+
+
+class RequestScheduler: 
+    # paces the DevOps calls of all threads. the calls wait for a token of 
+    # the bucket and for a free slot under the concurrency limit. throttled
+    # calls (a 429/503 response or Retry-After) are retried. Retry-After 
+    # pauses every call, and throttling or a low X-RateLimit-Remaining 
+    # halves the limit 
+
+    def __init__(self, rate_per_second=REQUEST_RATE_PER_SECOND, burst=REQUEST_BURST, 
+            max_concurrency=MAX_CONCURRENT_REQUESTS, initial_concurrency=MAX_WORKERS): 
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.limit = float(min(initial_concurrency, max_concurrency))
+        self.call_count = 0
+        self.throttled_count = 0
+        self.peak_concurrency = 0
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        # the limit is halved once per round of calls started after the 
+        # last decrease, the calls in flight saw the same throttling
+        self._round = 0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        # throttling seen in the response headers of the call on this thread
+        self._local = threading.local()
+
+    def watch(self, client): 
+        # observe the throttling headers of every response of an SDK client
+        service_client = client._client
+        send = service_client.send
+
+        def send_and_observe(*args, **kwargs): 
+            response = send(*args, **kwargs)
+            self.observe(response.status_code, response.headers)
+            export_metrics.observe_response(response)
+            return response
+
+        service_client.send = send_and_observe
+
+    def observe(self, status_code, headers): 
+        throttled = status_code in [429, 503]
+        pause_seconds = None
+        if headers.get('Retry-After') is not None: 
+            pause_seconds = _header_seconds(headers.get('Retry-After'))
+            throttled = True
+        # a failed call is retried only when its own response said so
+        self._local.retry = status_code in [429, 503] or headers.get('Retry-After') is not None
+        if float(headers.get('X-RateLimit-Delay') or 0) > 0: 
+            # DevOps is already delaying our requests
+            throttled = True
+        if headers.get('X-RateLimit-Remaining') is not None and headers.get('X-RateLimit-Limit') is not None: 
+            remaining = float(headers.get('X-RateLimit-Remaining'))
+            if remaining < float(headers.get('X-RateLimit-Limit')) * RATE_LIMIT_REMAINING_FRACTION: 
+                throttled = True
+                if remaining <= 0 and headers.get('X-RateLimit-Reset') is not None and pause_seconds is None: 
+                    pause_seconds = float(headers.get('X-RateLimit-Reset')) - time.time()
+
+        if throttled: 
+            self._local.throttled = True
+        if pause_seconds is not None and pause_seconds > 0: 
+            with self._condition: 
+                self._paused_until = max(self._paused_until, time.monotonic() + pause_seconds)
+
+    def _acquire(self): 
+        with self._condition: 
+            while True: 
+                now = time.monotonic()
+                self._tokens = min(float(self.burst), 
+                    self._tokens + (now - self._refilled_at) * self.rate_per_second)
+                self._refilled_at = now
+                if now < self._paused_until: 
+                    wait_seconds = self._paused_until - now
+                elif self._in_flight >= int(self.limit): 
+                    # woken up by _release
+                    wait_seconds = None
+                elif self.rate_per_second > 0 and self._tokens < 1: 
+                    wait_seconds = (1 - self._tokens) / self.rate_per_second
+                else: 
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    self.call_count += 1
+                    self.peak_concurrency = max(self.peak_concurrency, self._in_flight)
+                    return self._round
+                self._condition.wait(wait_seconds)
+
+    def _release(self, call_round, throttled): 
+        with self._condition: 
+            self._in_flight -= 1
+            if throttled: 
+                if call_round == self._round: 
+                    self.limit = max(1.0, self.limit / 2)
+                    self._round += 1
+            elif self.limit < self.max_concurrency: 
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def pause_seconds(self): 
+        with self._condition: 
+            return max(0.0, self._paused_until - time.monotonic())
+
+    def call(self, func, *args, **kwargs): 
+        delay = RETRY_BACKOFF_SECONDS
+        endpoint = getattr(func, '__name__', 'call')
+        for attempt in range(MAX_RETRIES + 1): 
+            call_round = self._acquire()
+            self._local.throttled = False
+            self._local.retry = False
+            retry_error = None
+            outcome = 'error'
+            start = time.perf_counter()
+            try: 
+                result = func(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            except AzureDevOpsClientRequestError as error: 
+                if self._local.retry: 
+                    outcome = 'throttled'
+                if attempt == MAX_RETRIES or not self._local.retry: 
+                    raise
+                retry_error = error
+            finally: 
+                export_metrics.observe_call(endpoint, time.perf_counter() - start, outcome)
+                self._release(call_round, retry_error is not None or self._local.throttled)
+
+            with self._condition: 
+                self.throttled_count += 1
+
+            # wait out Retry-After, otherwise back off with jitter so the 
+            # workers don't retry in lockstep
+            wait_seconds = self.pause_seconds()
+            if wait_seconds <= 0: 
+                wait_seconds = delay + random.uniform(0, delay)
+            print("request throttled ({0}), retrying in {1:.1f}s (concurrency {2})".format(
+                retry_error, wait_seconds, int(self.limit)))
+            time.sleep(wait_seconds)
+            delay *= 2
+
+
+class ExportMetrics: 
+    # what a run spent its time on: wall time per stage (summed over the 
+    # threads running it), API calls with their latency histogram and 
+    # outcome per endpoint, response bytes, cache hits and rows written. 
+    # saved as json, or as a Prometheus textfile when the file ends in .prom
+
+    def __init__(self): 
+        self.started = time.time()
+        self.stages = {}
+        self.api_calls = {}
+        self.response_bytes = 0
+        self.rows_written = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, stage_name): 
+        start = time.perf_counter()
+        try: 
+            yield
+        finally: 
+            self.observe_stage(stage_name, time.perf_counter() - start)
+
+    def observe_stage(self, stage_name, seconds): 
+        with self._lock: 
+            stage = self.stages.setdefault(stage_name, {'seconds': 0.0, 'count': 0})
+            stage['seconds'] += seconds
+            stage['count'] += 1
+
+    def observe_call(self, endpoint, seconds, outcome): 
+        # outcome is ok, throttled or error
+        with self._lock: 
+            api_call = self.api_calls.get(endpoint)
+            if api_call is None: 
+                api_call = self.api_calls[endpoint] = {'count': 0, 'seconds': 0.0, 
+                    'ok': 0, 'throttled': 0, 'error': 0, 'buckets': [0] * len(LATENCY_BUCKETS)}
+            api_call['count'] += 1
+            api_call['seconds'] += seconds
+            api_call[outcome] += 1
+            for b in range(len(LATENCY_BUCKETS)): 
+                if seconds <= LATENCY_BUCKETS[b]: 
+                    api_call['buckets'][b] += 1
+
+    def observe_response(self, response): 
+        content = response.content
+        with self._lock: 
+            self.response_bytes += len(content) if content is not None else 0
+
+    def count_rows(self, output_name, row_count): 
+        with self._lock: 
+            self.rows_written[output_name] = self.rows_written.get(output_name, 0) + row_count
+
+    def observe_cache(self, cache): 
+        self.cache_hits = cache.hits
+        self.cache_misses = cache.misses
+
+    def as_dict(self, scheduler=None): 
+        cache_lookups = self.cache_hits + self.cache_misses
+        metrics = {
+            'started': datetime.fromtimestamp(self.started, pytz.utc).isoformat(), 
+            'run_seconds': time.time() - self.started, 
+            'stages': self.stages, 
+            'api_calls': dict((endpoint, dict(api_call, buckets=dict(
+                    (str(LATENCY_BUCKETS[b]), api_call['buckets'][b]) for b in range(len(LATENCY_BUCKETS))))) 
+                for endpoint, api_call in self.api_calls.items()), 
+            'response_bytes': self.response_bytes, 
+            'cache': {'hits': self.cache_hits, 'misses': self.cache_misses, 
+                'hit_rate': self.cache_hits / cache_lookups if cache_lookups > 0 else None}, 
+            'rows_written': self.rows_written
+        }
+        if scheduler is not None: 
+            metrics['requests'] = {'count': scheduler.call_count, 'throttled': scheduler.throttled_count, 
+                'peak_concurrency': scheduler.peak_concurrency, 'concurrency_limit': scheduler.limit}
+        return metrics
+
+    def to_prometheus(self, scheduler=None): 
+        lines = []
+
+        def metric(name, metric_type, help_text, samples): 
+            # samples of (name suffix, labels, value)
+            lines.append("# HELP devops_export_{0} {1}".format(name, help_text))
+            lines.append("# TYPE devops_export_{0} {1}".format(name, metric_type))
+            for suffix, labels, value in samples: 
+                label_text = ','.join(['{0}="{1}"'.format(key, str(label).replace('\\', '\\\\').replace('"', '\\"')) 
+                    for key, label in labels])
+                lines.append("devops_export_{0}{1}{2} {3}".format(name, suffix, 
+                    '{' + label_text + '}' if label_text else '', value))
+
+        metric('run_seconds', 'gauge', 'Wall time of the export run.', [('', [], time.time() - self.started)])
+        metric('last_run_timestamp_seconds', 'gauge', 'Start of the export run.', [('', [], self.started)])
+        metric('stage_seconds', 'gauge', 'Time spent in each stage, summed over the threads.', 
+            [('', [('stage', stage_name)], stage['seconds']) for stage_name, stage in sorted(self.stages.items())])
+        metric('api_calls', 'gauge', 'API calls by endpoint and outcome.', 
+            [('', [('endpoint', endpoint), ('outcome', outcome)], api_call[outcome]) 
+                for endpoint, api_call in sorted(self.api_calls.items()) for outcome in ['ok', 'throttled', 'error']])
+        histogram = []
+        for endpoint, api_call in sorted(self.api_calls.items()): 
+            for b in range(len(LATENCY_BUCKETS)): 
+                histogram.append(('_bucket', [('endpoint', endpoint), ('le', LATENCY_BUCKETS[b])], api_call['buckets'][b]))
+            histogram.append(('_bucket', [('endpoint', endpoint), ('le', '+Inf')], api_call['count']))
+            histogram.append(('_sum', [('endpoint', endpoint)], api_call['seconds']))
+            histogram.append(('_count', [('endpoint', endpoint)], api_call['count']))
+        metric('api_call_seconds', 'histogram', 'API call latency by endpoint.', histogram)
+        metric('response_bytes', 'gauge', 'Bytes received from DevOps.', [('', [], self.response_bytes)])
+        metric('cache_lookups', 'gauge', 'Work item cache lookups by result.', 
+            [('', [('result', 'hit')], self.cache_hits), ('', [('result', 'miss')], self.cache_misses)])
+        metric('rows_written', 'gauge', 'Rows written by output.', 
+            [('', [('output', output_name)], row_count) for output_name, row_count in sorted(self.rows_written.items())])
+        if scheduler is not None: 
+            metric('request_concurrency_limit', 'gauge', 'Concurrency limit of the request scheduler at the end.', 
+                [('', [], scheduler.limit)])
+            metric('request_peak_concurrency', 'gauge', 'Most requests in flight at once.', 
+                [('', [], scheduler.peak_concurrency)])
+        return '\n'.join(lines) + '\n'
+
+    def save(self, file_path, scheduler=None): 
+        # write next to the target first, the textfile collector may read it any time
+        temp_file_path = file_path + '.tmp'
+        with open(temp_file_path, 'w') as metrics_file: 
+            if file_path.endswith('.prom'): 
+                metrics_file.write(self.to_prometheus(scheduler))
+            else: 
+                json.dump(self.as_dict(scheduler), metrics_file, indent=2)
+        os.replace(temp_file_path, file_path)
+
+
+export_metrics = ExportMetrics()
+request_scheduler = RequestScheduler()
+
+
+def _call_with_retry(func, *args, **kwargs): 
+    return request_scheduler.call(func, *args, **kwargs)
+
+
+class WorkItemCache: 
+    # work items are keyed by id and stored at their latest rev, revision 
+    # histories are keyed by (id, rev) so any change to an item invalidates them. 
+    # each WIQL query keeps the time its last sync started (less 
+    # DELTA_WATERMARK_OVERLAP_SECONDS) as a watermark, so later runs only 
+    # fetch the items changed since then.
+
+    def __init__(self, file_path, max_age_days=CACHE_MAX_AGE_DAYS): 
+        folder = os.path.dirname(file_path)
+        if folder != '' and not os.path.exists(folder): 
+            os.makedirs(folder)
+        self.file_path = file_path
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        # the revision workers share the connection 
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(file_path, check_same_thread=False)
+        self._db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS work_items (
+                id INTEGER PRIMARY KEY, rev INTEGER, changed_date TEXT, 
+                fields TEXT, last_used REAL);
+            CREATE TABLE IF NOT EXISTS updates (
+                id INTEGER, rev INTEGER, updates TEXT, last_used REAL, 
+                PRIMARY KEY (id, rev));
+            CREATE TABLE IF NOT EXISTS queries (
+                wiql TEXT PRIMARY KEY, watermark TEXT, last_used REAL);
+        """)
+
+    def get_watermark(self, wiql_query): 
+        with self._lock: 
+            row = self._db.execute(
+                "SELECT watermark FROM queries WHERE wiql = ?", (wiql_query,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_watermark(self, wiql_query, watermark): 
+        with self._lock: 
+            self._db.execute("INSERT OR REPLACE INTO queries VALUES (?, ?, ?)", 
+                (wiql_query, watermark, time.time()))
+            self._db.commit()
+
+    def get_work_items(self, id_list): 
+        work_items = {}
+        with self._lock: 
+            # stay below the sqlite host parameter limit
+            for i in range(0, len(id_list), 500): 
+                batch = id_list[i:i + 500]
+                rows = self._db.execute(
+                    "SELECT id, rev, fields FROM work_items WHERE id IN ({0})".format(
+                        ','.join('?' * len(batch))), batch).fetchall()
+                for item_id, rev, fields in rows: 
+                    work_items[item_id] = WorkItemRecord(item_id, rev, json.loads(fields))
+                self._db.execute(
+                    "UPDATE work_items SET last_used = ? WHERE id IN ({0})".format(
+                        ','.join('?' * len(batch))), [time.time()] + batch)
+            self._db.commit()
+            self.hits += len(work_items)
+            self.misses += len(id_list) - len(work_items)
+        return work_items
+
+    def count_misses(self, count): 
+        # the items downloaded without looking them up
+        with self._lock: 
+            self.misses += count
+
+    def put_work_items(self, work_item_list): 
+        now = time.time()
+        with self._lock: 
+            for work_item in work_item_list: 
+                # never replace a cached item with an older rev 
+                self._db.execute(
+                    "INSERT INTO work_items VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET rev = excluded.rev, "
+                    "changed_date = excluded.changed_date, fields = excluded.fields, "
+                    "last_used = excluded.last_used WHERE excluded.rev >= work_items.rev", 
+                    (work_item.id, work_item.rev, work_item.get('System.ChangedDate'), 
+                    json.dumps(work_item.to_dict()), now))
+            self._db.commit()
+
+    def get_updates(self, item_id, rev): 
+        with self._lock: 
+            row = self._db.execute(
+                "SELECT updates FROM updates WHERE id = ? AND rev = ?", (item_id, rev)).fetchone()
+            if row is not None: 
+                self._db.execute("UPDATE updates SET last_used = ? WHERE id = ? AND rev = ?", 
+                    (time.time(), item_id, rev))
+        if row is None: 
+            self.misses += 1
+            return None
+        self.hits += 1
+        return _work_item_updates_from_dicts(json.loads(row[0]))
+
+    def put_updates(self, item_id, rev, updates): 
+        serialized = json.dumps([update.as_dict() for update in updates])
+        with self._lock: 
+            self._db.execute("INSERT OR REPLACE INTO updates VALUES (?, ?, ?, ?)", 
+                (item_id, rev, serialized, time.time()))
+            self._db.commit()
+
+    def compact(self): 
+        # drop superseded revisions and anything not used for max_age_days 
+        cutoff = time.time() - self.max_age_days * 24 * 3600
+        with self._lock: 
+            deleted = 0
+            deleted += self._db.execute(
+                "DELETE FROM updates WHERE rev < "
+                "(SELECT rev FROM work_items WHERE work_items.id = updates.id)").rowcount
+            deleted += self._db.execute(
+                "DELETE FROM work_items WHERE last_used < ?", (cutoff,)).rowcount
+            deleted += self._db.execute(
+                "DELETE FROM updates WHERE last_used < ?", (cutoff,)).rowcount
+            deleted += self._db.execute(
+                "DELETE FROM queries WHERE last_used < ?", (cutoff,)).rowcount
+            self._db.commit()
+            free_pages = self._db.execute("PRAGMA freelist_count").fetchone()[0]
+            pages = self._db.execute("PRAGMA page_count").fetchone()[0]
+            if pages > 0 and free_pages >= pages * CACHE_VACUUM_FREE_FRACTION: 
+                # give the freed pages back to the file system 
+                self._db.execute("VACUUM")
+        return deleted
+
+    def close(self): 
+        with self._lock: 
+            self._db.close()
+
+
+class TeamIterationIndex: 
+    # the iterations of a team, downloaded once per run (or loaded from the 
+    # cache folder when fresh) and sorted by start date. iterations without
+    # dates or starting before start_year are left out.
+
+    def __init__(self, team_context, start_year=ITERATION_START_YEAR, 
+            cache_folder=None, ttl_seconds=ITERATION_CACHE_TTL_SECONDS): 
+        self.team_context = team_context
+        self.start_year = start_year
+
+        iteration_list = None
+        cache_file_path = None
+        if cache_folder is not None: 
+            cache_file_path = os.path.join(cache_folder, "team_iterations_{0}_{1}.json".format(
+                team_context.project, team_context.team).replace(' ', '_'))
+            iteration_list = self._load(cache_file_path, ttl_seconds)
+
+        if iteration_list is None: 
+            iteration_list = self._download()
+            if cache_file_path is not None: 
+                self._save(cache_file_path, iteration_list)
+
+        self.timeline = sorted([iteration for iteration in iteration_list 
+            if iteration['iteration_start_date'].year >= start_year], 
+            key=lambda iteration: iteration['iteration_start_date'])
+        self._start_dates = [iteration['iteration_start_date'] for iteration in self.timeline]
+        self._by_path = dict((iteration['iteration_path'], iteration) for iteration in self.timeline)
+        self._by_id = dict((iteration['iteration_id'], iteration) for iteration in self.timeline)
+
+    def _download(self): 
+        work_client = connection.clients.get_work_client()
+
+        iteration_list = []
+        get_team_iterations_response = _call_with_retry(
+            work_client.get_team_iterations, self.team_context)
+        if get_team_iterations_response is not None: 
+            for team_iteration in get_team_iterations_response: 
+                if team_iteration.attributes is None \
+                    or team_iteration.attributes.start_date is None \
+                    or team_iteration.attributes.finish_date is None: 
+                    # skip the iterations without dates
+                    continue
+                iteration_list.append({
+                    'iteration_id': team_iteration.id, 
+                    'iteration_name': team_iteration.name, 
+                    'iteration_path': team_iteration.path, 
+                    'iteration_start_date': team_iteration.attributes.start_date, 
+                    'iteration_due_date': team_iteration.attributes.finish_date
+                })
+        return iteration_list
+
+    @staticmethod
+    def _load(cache_file_path, ttl_seconds): 
+        if not os.path.exists(cache_file_path) \
+            or time.time() - os.path.getmtime(cache_file_path) > ttl_seconds: 
+            return None
+        try: 
+            with open(cache_file_path, 'r') as cache_file: 
+                iteration_list = json.load(cache_file)
+            for iteration in iteration_list: 
+                iteration['iteration_start_date'] = datetime.fromisoformat(iteration['iteration_start_date'])
+                iteration['iteration_due_date'] = datetime.fromisoformat(iteration['iteration_due_date'])
+        except (ValueError, KeyError, TypeError): 
+            # a damaged cache file is downloaded again
+            return None
+        return iteration_list
+
+    @staticmethod
+    def _save(cache_file_path, iteration_list): 
+        folder = os.path.dirname(cache_file_path)
+        if not os.path.exists(folder): 
+            os.makedirs(folder)
+        # write next to the cache file first, so a concurrent run never
+        # reads half a file
+        temp_file_path = '{0}.{1}.tmp'.format(cache_file_path, os.getpid())
+        with open(temp_file_path, 'w') as cache_file: 
+            json.dump(iteration_list, cache_file, default=lambda value: value.isoformat())
+        os.replace(temp_file_path, cache_file_path)
+
+    def get(self, iteration_path): 
+        return self._by_path.get(iteration_path)
+
+    def get_by_id(self, iteration_id): 
+        return self._by_id.get(iteration_id)
+
+    def started(self, today=None): 
+        # the iterations started by today, i.e. not in the future
+        if today is None: 
+            today = today_timezone
+        return self.timeline[:bisect_right(self._start_dates, today)]
+
+    def current(self, today=None): 
+        if today is None: 
+            today = today_timezone
+        started_iterations = self.started(today)
+        if len(started_iterations) > 0 \
+            and started_iterations[-1]['iteration_due_date'].date() >= today.date(): 
+            return started_iterations[-1]
+        return None
+
+    def between(self, start_date, finish_date): 
+        # the iterations overlapping [start_date, finish_date]
+        return [iteration for iteration in self.timeline[:bisect_right(self._start_dates, finish_date)] 
+            if iteration['iteration_due_date'] >= start_date]
+
+
+def _print_iteration(index, iteration): 
+    if not verbose: 
+        return
+    print("Iteration [{0}]: {1}, {2} ({3} -> {4})".format(
+        index, iteration['iteration_name'], iteration['iteration_path'], 
+        iteration['iteration_start_date'].strftime("%Y-%m-%d"),
+        iteration['iteration_due_date'].strftime("%Y-%m-%d")
+        ))
+
+
+def get_current_iteration(team_context, iteration_index=None, today=None): 
+
+    if iteration_index is None: 
+        iteration_index = TeamIterationIndex(team_context)
 
     iteration_id = None
     iteration_path = None
     iteration_due_date = None
 
-    # get the iteration paths
-    index = 0 
-    get_team_iterations_response = work_client.get_team_iterations(team_context, 'current')
-    if get_team_iterations_response is not None: 
-        for team_iteration in get_team_iterations_response: 
-            start_date = team_iteration.attributes.start_date
-            if start_date.year < 2021 or start_date > today_timezone: 
-                # skip the iterations of last year and the future
-                None
-            else: 
-                iteration_path = team_iteration.path
-                iteration_id = team_iteration.id
-                iteration_due_date = team_iteration.attributes.finish_date 
-                print("Iteration [{0}]: {1}, {2} ({3} -> {4})".format(
-                    index, team_iteration.name, team_iteration.path, 
-                    team_iteration.attributes.start_date.strftime("%Y-%m-%d"),
-                    team_iteration.attributes.finish_date.strftime("%Y-%m-%d")
-                    ))
-                index += 1
-        # All team iterations have been retrieved
-        get_team_iterations_response = None
+    iteration = iteration_index.current(today)
+    if iteration is not None: 
+        iteration_path = iteration['iteration_path']
+        iteration_id = iteration['iteration_id']
+        iteration_due_date = iteration['iteration_due_date']
+        _print_iteration(0, iteration)
 
-    return iteration_id, current_iteration, iteration_due_date
+    return iteration_id, iteration_path, iteration_due_date
 
 
-def get_iteration(team_context, iteration_path): 
+def get_iteration(team_context, iteration_path, iteration_index=None, today=None): 
 
-    work_client = connection.clients.get_work_client()
+    if iteration_index is None: 
+        iteration_index = TeamIterationIndex(team_context)
 
     iteration_id = None
     iteration_due_date = None
 
-    # get the iteration paths
-    index = 0 
-    get_team_iterations_response = work_client.get_team_iterations(team_context)
-    if get_team_iterations_response is not None: 
-        for team_iteration in get_team_iterations_response: 
-            start_date = team_iteration.attributes.start_date
-            if start_date.year < 2021 or start_date > today_timezone: 
-                # skip the iterations of last year and the future
-                continue
-            elif iteration_path == team_iteration.path:
-                iteration_id = team_iteration.id
-                iteration_due_date = team_iteration.attributes.finish_date 
-                print("Iteration [{0}]: {1}, {2} ({3} -> {4})".format(
-                    index, team_iteration.name, team_iteration.path, 
-                    team_iteration.attributes.start_date.strftime("%Y-%m-%d"),
-                    team_iteration.attributes.finish_date.strftime("%Y-%m-%d")
-                    ))
-                index += 1
-        # All team iterations have been retrieved
-        get_team_iterations_response = None
+    if today is None: 
+        today = today_timezone
+
+    iteration = iteration_index.get(iteration_path)
+    if iteration is not None and iteration['iteration_start_date'] <= today: 
+        # skip the iterations in the future
+        iteration_id = iteration['iteration_id']
+        iteration_due_date = iteration['iteration_due_date']
+        _print_iteration(0, iteration)
 
     return iteration_id, iteration_due_date
 
 
-def get_past_iterations(team_context): 
+def get_past_iterations(team_context, iteration_index=None, today=None): 
 
-    work_client = connection.clients.get_work_client()
+    if iteration_index is None: 
+        iteration_index = TeamIterationIndex(team_context)
 
     iteration_list = []
 
-    # get the iteration paths
-    index = 0 
-    get_team_iterations_response = work_client.get_team_iterations(team_context)
-    if get_team_iterations_response is not None: 
-        for team_iteration in get_team_iterations_response: 
-            start_date = team_iteration.attributes.start_date
-            if start_date.year < 2021 or start_date > today_timezone: 
-                # skip the iterations of last year and the future
-                continue
-            else:
-                iteration_path = team_iteration.path
-                iteration_id = team_iteration.id
-                iteration_due_date = team_iteration.attributes.finish_date                 
-                print("Iteration [{0}]: {1}, {2} ({3} -> {4})".format(
-                    index, team_iteration.name, team_iteration.path, 
-                    team_iteration.attributes.start_date.strftime("%Y-%m-%d"),
-                    team_iteration.attributes.finish_date.strftime("%Y-%m-%d")
-                    ))
-                iteration_list.append({
-                    'iteration_id': iteration_id, 
-                    'iteration_path': iteration_path, 
-                    'iteration_due_date': iteration_due_date
-                })
-                index += 1
-        # All team iterations have been retrieved
-        get_team_iterations_response = None
+    # skip the iterations in the future
+    for index, iteration in enumerate(iteration_index.started(today)): 
+        _print_iteration(index, iteration)
+        iteration_list.append({
+            'iteration_id': iteration['iteration_id'], 
+            'iteration_path': iteration['iteration_path'], 
+            'iteration_due_date': iteration['iteration_due_date']
+        })
 
     return iteration_list
 
 
-def _retrieve_work_items(team_context, wiql_query):
+class WorkItemRecord: 
+    # the values of record_field_names of a work item, in that order. the 
+    # SDK WorkItem keeps every field and the whole AssignedTo identity, this 
+    # keeps the display name and shares the repeating strings
+    __slots__ = ('id', 'rev', 'values')
+
+    def __init__(self, item_id, rev, fields): 
+        self.id = item_id
+        self.rev = rev
+        self.values = [None] * len(record_field_names)
+        for field_name, value in fields.items(): 
+            index = record_field_index.get(field_name)
+            if index is None or value is None: 
+                continue
+            if field_name == 'System.AssignedTo' and isinstance(value, dict): 
+                # the cache may still hold the identity from before
+                value = value.get('displayName')
+            if field_name in interned_field_names and isinstance(value, str): 
+                value = sys.intern(value)
+            self.values[index] = value
+
+    def get(self, field_name, default=None): 
+        index = record_field_index.get(field_name)
+        if index is None or self.values[index] is None: 
+            return default
+        return self.values[index]
+
+    def set(self, field_name, value): 
+        self.values[record_field_index[field_name]] = value
+
+    def copy(self): 
+        # the same values, for a team setting its own roll-ups
+        work_item = WorkItemRecord.__new__(WorkItemRecord)
+        work_item.id = self.id
+        work_item.rev = self.rev
+        work_item.values = list(self.values)
+        return work_item
+
+    def to_dict(self): 
+        # the fields with a value, as stored in the cache
+        return dict((record_field_names[i], value) for i, value in enumerate(self.values) if value is not None)
+
+
+class AreaTeamContext(workModels.TeamContext): 
+    # a team narrowed to an area path (and its sub areas), the queries of a 
+    # plain TeamContext cover the root area of the project
+
+    def __init__(self, project=None, team=None, area_path=None, include_sub_areas=False): 
+        workModels.TeamContext.__init__(self, project=project, team=team)
+        self.area_path = area_path
+        self.include_sub_areas = include_sub_areas
+
+
+class SharedFetches: 
+    # the work items and revision histories fetched by the teams of a 
+    # --batch run. a key asked for by several teams is downloaded once, 
+    # the others wait for it. once done, the result is read back from the 
+    # cache, or kept here when there is no cache
+
+    def __init__(self, cache=None): 
+        self.cache = cache
+        self._futures = {}
+        self._done_keys = set()
+        self._lock = threading.Lock()
+        self.fetched_count = 0
+        self.shared_count = 0
+
+    def claim(self, key_list): 
+        # ({key: future} to wait for, keys to fetch, keys done and cached)
+        waiting = {}
+        owned_key_list = []
+        done_key_list = []
+        with self._lock: 
+            for key in key_list: 
+                if key in self._futures: 
+                    waiting[key] = self._futures[key]
+                elif key in self._done_keys: 
+                    done_key_list.append(key)
+                else: 
+                    self._futures[key] = Future()
+                    owned_key_list.append(key)
+            self.fetched_count += len(owned_key_list)
+            self.shared_count += len(waiting) + len(done_key_list)
+        return waiting, owned_key_list, done_key_list
+
+    def resolve(self, key, result=None, error=None): 
+        with self._lock: 
+            if self.cache is None and error is None: 
+                future = self._futures[key]
+            else: 
+                future = self._futures.pop(key)
+                if error is None: 
+                    self._done_keys.add(key)
+        if error is None: 
+            future.set_result(result)
+        else: 
+            future.set_exception(error)
+
+    def fetch_once(self, key, fetch): 
+        waiting, owned_key_list, done_key_list = self.claim([key])
+        if len(owned_key_list) > 0: 
+            try: 
+                result = fetch()
+            except BaseException as e: 
+                self.resolve(key, error=e)
+                raise
+            self.resolve(key, result)
+            return result
+        if len(done_key_list) > 0: 
+            # in the cache by now
+            return fetch()
+        return waiting[key].result()
+
+
+# set by --batch, None for a single team
+shared_fetches = None
+
+# set by --as-of, the date the work items are exported as of, None for now
+snapshot_as_of = None
+
+wiql_operators = ('=', '<>', '<', '>', '<=', '>=', 'UNDER', 'NOT UNDER', 'IN', 'NOT IN')
+
+_wiql_parameter_pattern = re.compile(r'\{(\w+)\}')
+_wiql_order_by_pattern = re.compile(r'\sorder\s+by\s', re.IGNORECASE)
+_wiql_as_of_pattern = re.compile(r'\sasof\s', re.IGNORECASE)
+
+
+def wiql_literal(value): 
+    # the WIQL literal of a value: numbers as they are, dates in UTC, lists 
+    # comma separated and strings quoted with their quotes doubled
+    if isinstance(value, bool) or value is None: 
+        raise Exception("No WIQL literal for {0!r}.".format(value))
+    if isinstance(value, (int, float)): 
+        return str(value)
+    if isinstance(value, datetime): 
+        value = value.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    if isinstance(value, (list, tuple, set)): 
+        return ', '.join([wiql_literal(item) for item in value])
+    value = str(value)
+    if any(ord(character) < 32 for character in value): 
+        raise Exception("WIQL value with a control character: {0!r}".format(value))
+    return "'" + value.replace("'", "''") + "'"
+
+
+def build_wiql(wiql_template, parameters, operators=None): 
+    # the query of a template with its {Parameters} as WIQL literals and its 
+    # {Operators} checked against wiql_operators. the template is scanned 
+    # once, so a value can't add to the query
+    if operators is None: 
+        operators = {}
+
+    def substitute(match): 
+        name = match.group(1)
+        if name in operators: 
+            operator = operators[name]
+            if operator not in wiql_operators: 
+                raise Exception("Unknown WIQL operator ({0}) for {1}.".format(operator, name))
+            return operator
+        if name not in parameters: 
+            raise Exception("No value for the WIQL parameter {0}.".format(name))
+        return wiql_literal(parameters[name])
+
+    return _wiql_parameter_pattern.sub(substitute, wiql_template)
+
+
+def _narrow_wiql(wiql_query, condition, order_by=None): 
+    # the query with 'and <condition>' added to its where clause, and its 
+    # order by replaced by order_by if given. the order by and asof clauses
+    # follow the where clause
+    clause_list = list(_wiql_order_by_pattern.finditer(wiql_query)) or list(_wiql_as_of_pattern.finditer(wiql_query))
+    where_end = clause_list[-1].start() if len(clause_list) > 0 else len(wiql_query)
+    where_clause = wiql_query[:where_end].rstrip()
+    tail = wiql_query[where_end:]
+    if order_by is not None: 
+        as_of_list = list(_wiql_as_of_pattern.finditer(tail))
+        tail = " " + order_by + (tail[as_of_list[-1].start():] if len(as_of_list) > 0 else "")
+    return "{0} and {1} {2}".format(where_clause, condition, tail.lstrip())
+
+
+def _query_ids(team_context, wiql_query, time_precision=None, top=WIQL_RESULT_LIMIT): 
+    work_tracking_client = connection.clients.get_work_item_tracking_client()
+
+    query_by_wiql_response = _call_with_retry(work_tracking_client.query_by_wiql, 
+        workItemTrackingModels.Wiql(query=wiql_query), team_context, time_precision=time_precision, top=top)
+    if query_by_wiql_response is None: 
+        return None
+    return [work_item_id.id for work_item_id in query_by_wiql_response.work_items]
+
+
+def query_work_item_ids(team_context, wiql_query, time_precision=None, max_workers=MAX_WORKERS): 
+    # the work item ids of a query in its order, None without a response. 
+    # WIQL returns up to WIQL_RESULT_LIMIT ids, a query matching more is 
+    # split into id windows queried concurrently. the windows are merged in 
+    # id order, each in the order of the query
+    id_list = _query_ids(team_context, wiql_query, time_precision)
+    if id_list is None or len(id_list) < WIQL_RESULT_LIMIT: 
+        return id_list
+
+    # the id range of the query
+    first_id_list = _query_ids(team_context, _narrow_wiql(wiql_query, "[System.Id] > 0", 
+        "Order by [System.Id] asc"), time_precision, 1)
+    last_id_list = _query_ids(team_context, _narrow_wiql(wiql_query, "[System.Id] > 0", 
+        "Order by [System.Id] desc"), time_precision, 1)
+    if not first_id_list or not last_id_list: 
+        return id_list
+    first_id = first_id_list[0]
+    end_id = last_id_list[0] + 1
+    print("****** Splitting a query over {0} work items into id windows ....".format(WIQL_RESULT_LIMIT))
+
+    def window_bounds(start_id, end_id, count): 
+        step = max(1, -(-(end_id - start_id) // count))
+        return [(window_start, min(window_start + step, end_id)) for window_start in range(start_id, end_id, step)]
+
+    def query_window(start_id, end_id): 
+        return _query_ids(team_context, _narrow_wiql(wiql_query, 
+            "[System.Id] >= {0} and [System.Id] < {1}".format(wiql_literal(start_id), wiql_literal(end_id))), 
+            time_precision) or []
+
+    ids_by_window = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor: 
+        pending = dict((executor.submit(query_window, start_id, end_id), (start_id, end_id)) 
+            for start_id, end_id in window_bounds(first_id, end_id, WIQL_SPLIT_WINDOWS))
+        while len(pending) > 0: 
+            done, _ = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+            for future in done: 
+                start_id, end_id = pending.pop(future)
+                window_id_list = future.result()
+                if len(window_id_list) >= WIQL_RESULT_LIMIT and end_id - start_id > 1: 
+                    # still over the limit, halve the window
+                    for window in window_bounds(start_id, end_id, 2): 
+                        pending[executor.submit(query_window, *window)] = window
+                else: 
+                    ids_by_window[start_id] = window_id_list
+
+    return [item_id for start_id in sorted(ids_by_window.keys()) for item_id in ids_by_window[start_id]]
+
+
+def _query_changed_ids(team_context, wiql_query, watermark, max_workers=MAX_WORKERS): 
+    # narrow the query to the items changed after the watermark
+    changed_query = _narrow_wiql(wiql_query, "[System.ChangedDate] > {0}".format(wiql_literal(watermark)))
+    return set(query_work_item_ids(team_context, changed_query, True, max_workers) or [])
+
+
+def _fetch_shared_work_item_batch(work_tracking_client, batch_id_list, cache=None, changed_id_set=None): 
+    # the items another team fetched already (or is fetching) are not fetched again
+    waiting, owned_key_list, done_key_list = shared_fetches.claim(
+        [('work_item', item_id) for item_id in batch_id_list])
+
+    work_items = {}
+    fetched_count = 0
+    if len(owned_key_list) > 0: 
+        try: 
+            work_item_list, fetched_count = _fetch_work_item_batch(work_tracking_client, 
+                [key[1] for key in owned_key_list], cache, changed_id_set, False)
+        except BaseException as e: 
+            for key in owned_key_list: 
+                shared_fetches.resolve(key, error=e)
+            raise
+        for work_item in work_item_list: 
+            work_items[work_item.id] = work_item
+        for key in owned_key_list: 
+            shared_fetches.resolve(key, work_items.get(key[1]))
+    if len(done_key_list) > 0: 
+        work_items.update(shared_fetches.cache.get_work_items([key[1] for key in done_key_list]))
+    for key, future in waiting.items(): 
+        work_item = future.result()
+        if work_item is not None: 
+            work_items[key[1]] = work_item.copy()
+
+    # keep the order of the query
+    return [work_items[item_id] for item_id in batch_id_list if item_id in work_items], fetched_count
+
+
+def _fetch_work_item_batch(work_tracking_client, batch_id_list, cache=None, changed_id_set=None, shared=True): 
+    if shared and shared_fetches is not None: 
+        return _fetch_shared_work_item_batch(work_tracking_client, batch_id_list, cache, changed_id_set)
+
+    # only fetch the items missing from the cache or changed since the last sync. 
+    # on the first sync of a query (no changed_id_set) all of them are fetched
+    cached_work_items = {}
+    fetch_id_list = batch_id_list
+    if cache is not None: 
+        lookup_id_list = []
+        if changed_id_set is not None: 
+            lookup_id_list = [item_id for item_id in batch_id_list if item_id not in changed_id_set]
+            cached_work_items = cache.get_work_items(lookup_id_list)
+            fetch_id_list = [item_id for item_id in batch_id_list if item_id not in cached_work_items]
+        cache.count_misses(len(batch_id_list) - len(lookup_id_list))
+
+    fetched_work_items = {}
+    if len(fetch_id_list) > 0: 
+        get_work_items_response = _call_with_retry(
+            work_tracking_client.get_work_items, fetch_id_list, fields = work_item_field_names, as_of = snapshot_as_of)
+        if get_work_items_response is not None: 
+            # keep only the compact records, the SDK objects go with the response
+            for work_item in get_work_items_response: 
+                fetched_work_items[work_item.id] = WorkItemRecord(work_item.id, work_item.rev, work_item.fields or {})
+            get_work_items_response = None
+
+    if cache is not None and len(fetched_work_items) > 0: 
+        cache.put_work_items(fetched_work_items.values())
+
+    # keep the order of the query
+    work_item_list = []
+    for item_id in batch_id_list: 
+        if item_id in fetched_work_items: 
+            work_item_list.append(fetched_work_items[item_id])
+        elif item_id in cached_work_items: 
+            work_item_list.append(cached_work_items[item_id])
+
+    return work_item_list, len(fetched_work_items)
+
+
+def iterate_work_items(team_context, wiql_query, cache=None, max_workers=MAX_WORKERS): 
+    # yield the work items of a query in its order while up to max_workers 
+    # batches are fetched ahead, so only that window is held in memory
 
     # query the backlogs 
     work_tracking_client = connection.clients.get_work_item_tracking_client()
 
-    wiql = workItemTrackingModels.Wiql(query=wiql_query)
+    # an item changed after this may have been fetched before the change, 
+    # the next sync fetches the items changed since then again
+    sync_started = datetime.now(pytz.utc)
+
+    # collect all work item Ids 
+    idList = query_work_item_ids(team_context, wiql_query, None, max_workers)
+    if idList is None: 
+        return
 
-    query_by_wiql_response = work_tracking_client.query_by_wiql(wiql, team_context)
+    watermark = None
+    changed_id_set = None
+    if cache is not None: 
+        watermark = cache.get_watermark(wiql_query)
+        if watermark is not None: 
+            changed_id_set = _query_changed_ids(team_context, wiql_query, watermark, max_workers)
+
+    # output all work items, including parents not created in this iteration
+    batch_list = [idList[i:i + WORK_ITEM_BATCH_SIZE] 
+        for i in range(0, len(idList), WORK_ITEM_BATCH_SIZE)]
+    max_workers = max(1, max_workers)
 
     index = 0
-    idList = []
-    parentIdList = []
-    work_item_list = []
-    if query_by_wiql_response is not None:
-        # collect all work item Ids 
-        for work_item_id in query_by_wiql_response.work_items: 
-            # print("work item [{0}]: {1}".format(index, work_item_id.id))
-            index += 1
-            idList.append(work_item_id.id)
-
-        # output all work items, including parents not created in this iteration
-        i, j = 0, min(200, len(idList))
-        while i < len(idList):    
-            # get work items in a batch 
-            get_work_items_response = work_tracking_client.get_work_items(
-                idList[i:j], fields = pbi_field_names)
-            if get_work_items_response is not None: 
-                for work_item in get_work_items_response: 
-                    # output to the screen
+    fetched_count = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor: 
+        pending = deque()
+        next_batch = 0
+        while next_batch < len(batch_list) or len(pending) > 0: 
+            # keep the window of in-flight batches full 
+            while next_batch < len(batch_list) and len(pending) < max_workers: 
+                pending.append(executor.submit(_fetch_work_item_batch, 
+                    work_tracking_client, batch_list[next_batch], cache, changed_id_set))
+                next_batch += 1
+
+            work_item_list, batch_fetched_count = pending.popleft().result()
+            fetched_count += batch_fetched_count
+
+            for work_item in work_item_list: 
+                # output to the screen
+                if verbose: 
                     print("{0}, {1}: {2}".format(
-                        work_item.fields["System.WorkItemType"], 
-                        work_item.fields["System.Title"], 
-                        work_item.fields["System.State"]))
-                    # save to the return variable
-                    work_item_list.append(work_item)
+                        work_item.get("System.WorkItemType"), 
+                        work_item.get("System.Title"), 
+                        work_item.get("System.State")))
+                index += 1
+                yield work_item
 
-            i, j = j, min(j + 200, len(idList))
+    if cache is not None: 
+        # the whole query is in sync now
+        cache.set_watermark(wiql_query, (sync_started - timedelta(
+            seconds=DELTA_WATERMARK_OVERLAP_SECONDS)).strftime("%Y-%m-%dT%H:%M:%SZ"))
 
-        # All query results have been retrieved
-        print("total {0} work items retrieved".format(index))
-        idList = None
-        query_by_wiql_response = None
+    # All query results have been retrieved
+    print("total {0} work items retrieved ({1} downloaded)".format(index, fetched_count))
 
-        # return all work items
-        return work_item_list
 
+def _retrieve_work_items(team_context, wiql_query, cache=None, max_workers=MAX_WORKERS):
 
-def retrieve_PBIs(team_context, iteration_path):
+    # return all work items
+    return list(iterate_work_items(team_context, wiql_query, cache, max_workers))
 
-    wiql_pbi_query = pbi_wiql_template.replace( \
-        "{AreaPath}", team_context.project).replace( \
-        "{IterationPath}", iteration_path)
 
-    return _retrieve_work_items(team_context, wiql_pbi_query)
+def compose_wiql(wiql_template, team_context, iteration_path, parameters=None): 
+    # the area of an AreaTeamContext, or the root area of the project
+    area_path = getattr(team_context, 'area_path', None) or team_context.project
+    area_operator = 'UNDER' if getattr(team_context, 'include_sub_areas', False) else '='
+    wiql_parameters = {'AreaPath': area_path, 'IterationPath': iteration_path}
+    if parameters is not None: 
+        wiql_parameters.update(parameters)
+    wiql_query = build_wiql(wiql_template, wiql_parameters, {'AreaOperator': area_operator})
+    if snapshot_as_of is not None: 
+        # the work items matching the query on that date
+        wiql_query = "{0} ASOF {1}".format(wiql_query.rstrip(), wiql_literal(snapshot_as_of))
+    return wiql_query
 
 
-def retrieve_tasks(team_context, iteration_path): 
+def retrieve_PBIs(team_context, iteration_path, cache=None, max_workers=MAX_WORKERS):
 
-    wiql_task_query = task_wiql_template.replace( \
-        "{AreaPath}", team_context.project).replace( \
-        "{IterationPath}", iteration_path)
-        #"{ParentId}", str(pbi_id)) # System.Parent not applicable in filter 
+    wiql_pbi_query = compose_wiql(pbi_wiql_template, team_context, iteration_path)
 
-    return _retrieve_work_items(team_context, wiql_task_query)
+    return _retrieve_work_items(team_context, wiql_pbi_query, cache, max_workers)
 
 
-def get_lead_duration(team_context, item_id): 
-    # query the revision 
-    work_tracking_client = connection.clients.get_work_item_tracking_client()
+def retrieve_tasks(team_context, iteration_path, cache=None, max_workers=MAX_WORKERS): 
 
-    get_updates_response =  work_tracking_client.get_updates(item_id, project=team_context.project)
+    wiql_task_query = compose_wiql(task_wiql_template, team_context, iteration_path)
+    #"{ParentId}", str(pbi_id)) # System.Parent not applicable in filter 
 
-    create_date = None
-    start_date = None
-    finish_date = None
-    if get_updates_response is not None:
-        for revision in get_updates_response: 
-            if revision.fields is None:
-                # skip any non-field update
-                continue
+    return _retrieve_work_items(team_context, wiql_task_query, cache, max_workers)
+
+
+def retrieve_PBIs_with_tasks(team_context, iteration_path, cache=None, max_workers=MAX_WORKERS): 
+    # the PBIs and the Tasks of the iteration from one query, each in the 
+    # order of the query. System.Parent can't be filtered in WIQL, the tasks
+    # are matched to their PBI by index_children
+    wiql_hierarchy_query = compose_wiql(hierarchy_wiql_template, team_context, iteration_path)
+
+    pbi_list = []
+    task_list = []
+    for work_item in iterate_work_items(team_context, wiql_hierarchy_query, cache, max_workers): 
+        if work_item.get('System.WorkItemType') == 'Task': 
+            task_list.append(work_item)
+        else: 
+            pbi_list.append(work_item)
+    return pbi_list, task_list
+
+
+def index_children(work_item_list): 
+    # {parent id: [child work items]} 
+    children_index = {}
+    for work_item in work_item_list: 
+        parent_id = work_item.get('System.Parent')
+        if parent_id is not None: 
+            children_index.setdefault(parent_id, []).append(work_item)
+    return children_index
+
+
+def rollup_tasks(pbi_list, children_index, state_categories=None): 
+    # add the Rollup fields of task_rollup_field_names to each PBI 
+    if state_categories is None: 
+        state_categories = work_item_state_categories
+    task_categories = state_categories.get('Task', {})
+
+    for pbi in pbi_list: 
+        task_list = children_index.get(pbi.id, [])
+        remaining_work = 0.0
+        completed_work = 0.0
+        done_task_count = 0
+        for task in task_list: 
+            remaining_work += task.get('Microsoft.VSTS.Scheduling.RemainingWork', 0)
+            completed_work += task.get('Microsoft.VSTS.Scheduling.CompletedWork', 0)
+            if task_categories.get(task.get('System.State')) == 'Completed': 
+                done_task_count += 1
+        pbi.set('Rollup.TaskCount', len(task_list))
+        pbi.set('Rollup.DoneTaskCount', done_task_count)
+        pbi.set('Rollup.RemainingWork', remaining_work)
+        pbi.set('Rollup.CompletedWork', completed_work)
+    return pbi_list
+
+
+def get_revision_history(team_context, item_id, rev=None, cache=None): 
+    if shared_fetches is not None and rev is not None: 
+        return shared_fetches.fetch_once(('updates', item_id, rev), 
+            lambda: _get_revision_history(team_context, item_id, rev, cache))
+    return _get_revision_history(team_context, item_id, rev, cache)
+
+
+def _get_revision_history(team_context, item_id, rev=None, cache=None): 
+    get_updates_response = None
+    if cache is not None and rev is not None: 
+        # the revisions are unchanged as long as the item is at the same rev
+        get_updates_response = cache.get_updates(item_id, rev)
+
+    if get_updates_response is None: 
+        # query the revision 
+        work_tracking_client = connection.clients.get_work_item_tracking_client()
+
+        get_updates_response = _call_with_retry(
+            work_tracking_client.get_updates, item_id, project=team_context.project)
+
+        if cache is not None and rev is not None and get_updates_response is not None: 
+            cache.put_updates(item_id, rev, get_updates_response)
+
+    return get_updates_response
+
+
+def get_revision_histories(team_context, work_item_list, max_workers=MAX_WORKERS, cache=None): 
+    # fetch the revisions of all work items concurrently 
+    id_list = [work_item.id for work_item in work_item_list]
+    rev_list = [work_item.rev for work_item in work_item_list]
+
+    # create the client once before the workers share it
+    connection.clients.get_work_item_tracking_client()
+
+    revision_histories = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor: 
+        results = executor.map(lambda item_id, rev: get_revision_history(team_context, item_id, rev, cache), 
+            id_list, rev_list)
+        for item_id, revision_history in zip(id_list, results): 
+            revision_histories[item_id] = revision_history
+
+    print("total {0} revision histories retrieved".format(len(revision_histories)))
+    return revision_histories
+
+
+def load_state_categories(file_path): 
+    # {work item type: {state: category}} from a json file, the work item 
+    # types not in the file keep their default categories
+    with open(file_path, 'r') as state_categories_file: 
+        state_categories = json.load(state_categories_file)
+
+    for work_item_type, categories in state_categories.items(): 
+        for state, category in categories.items(): 
+            if category not in STATE_CATEGORIES: 
+                raise Exception("Unknown category ({0}) of {1} state ({2}) in {3}, expected one of {4}.".format(
+                    category, work_item_type, state, file_path, ', '.join(STATE_CATEGORIES)))
+
+    merged_state_categories = dict(work_item_state_categories)
+    merged_state_categories.update(state_categories)
+    return merged_state_categories
+
+
+def _compile_state_categories(state_categories): 
+    # {work item type: {state: category index}}. the states unknown to a 
+    # work item type fall back to their category in any type
+    fallback_lookup = {}
+    for work_item_type, categories in state_categories.items(): 
+        for state, category in categories.items(): 
+            fallback_lookup.setdefault(state, STATE_CATEGORIES.index(category))
+
+    category_lookup = {}
+    for work_item_type, categories in state_categories.items(): 
+        category_lookup[work_item_type] = dict(fallback_lookup)
+        for state, category in categories.items(): 
+            category_lookup[work_item_type][state] = STATE_CATEGORIES.index(category)
+    return category_lookup, fallback_lookup
+
+
+def _import_numpy(): 
+    # numpy is optional, without it the flow metrics are computed row by row
+    try: 
+        import numpy
+    except ImportError: 
+        return None
+    return numpy
+
+
+def _date_seconds(changed_date): 
+    return datetime.fromisoformat(changed_date.replace('Z', '+00:00')).timestamp()
+
+
+def _flow_rows_python(item_column, seconds_column, state_column, category_column, item_count, as_of_seconds, with_dwell=True): 
+    # one pass over the state changes, grouped by item in revision order
+    created_rows = [-1] * item_count
+    start_rows = [-1] * item_count
+    finish_rows = [-1] * item_count
+    reopen_counts = [0] * item_count
+    dwell_days = [{} for item in range(item_count)] if with_dwell else None
+
+    row_count = len(item_column)
+    for row in range(row_count): 
+        item = item_column[row]
+        category = category_column[row]
+        previous_category = category_column[row - 1] if row > 0 and item_column[row - 1] == item else UNCATEGORIZED
+        has_next = row + 1 < row_count and item_column[row + 1] == item
+
+        # the item stays in the state until its next change, the last state
+        # until as_of unless the item is done
+        if with_dwell: 
+            if has_next: 
+                duration = seconds_column[row + 1] - seconds_column[row]
+            elif category != COMPLETED and category != REMOVED: 
+                duration = as_of_seconds - seconds_column[row]
             else: 
-                field_revision = revision.fields
-                fields_of_interest = ['System.State']
-                for field_name in fields_of_interest:
-                    if field_name in field_revision.keys(): 
-                        iteration_path = None
-                        if 'System.IterationPath' in field_revision.keys(): 
-                            iteration_path = field_revision['System.IterationPath'].new_value
-                        changed_date = field_revision['System.ChangedDate'].new_value
-                        print("{0} - {1} [{2}, {3}]: {4} -> {5}".format(item_id, field_name, 
-                            changed_date, iteration_path, 
-                            field_revision[field_name].old_value, field_revision[field_name].new_value))
-                        if field_revision[field_name].new_value == 'New' and create_date is None: 
-                            # the first start date of Product Backlog Item
-                            create_date = changed_date
-                            # new work found. reset the finish date 
-                            finish_date = None
-                        elif field_revision[field_name].new_value == 'To Do' and create_date is None: 
-                            # the first start date of Task
-                            create_date = changed_date
-                            # new work found. reset the finish date 
-                            finish_date = None
-                        elif field_revision[field_name].new_value == 'Started' and start_date is None: 
-                            # the first start date of Product Backlog Item
-                            start_date = changed_date
-                            # new work found. reset the finish date 
-                            finish_date = None
-                        elif field_revision[field_name].new_value == 'In Progress' and start_date is None: 
-                            # the first start date of Task
-                            start_date = changed_date
-                            # new work found. reset the finish date 
-                            finish_date = None
-                        elif field_revision[field_name].new_value == 'Done': 
-                            # the last finish date of Product Backlog Item or Task
-                            finish_date = changed_date
-
-    return (create_date if start_date is None else start_date), finish_date
+                duration = 0
+            if duration != 0: 
+                state = state_column[row]
+                dwell_days[item][state] = dwell_days[item].get(state, 0) + duration / SECONDS_PER_DAY
+
+        if category == PROPOSED and created_rows[item] < 0: 
+            created_rows[item] = row
+        elif category == IN_PROGRESS and start_rows[item] < 0: 
+            start_rows[item] = row
+
+        if category == COMPLETED: 
+            if previous_category != COMPLETED: 
+                finish_rows[item] = row
+        elif previous_category == COMPLETED: 
+            reopen_counts[item] += 1
+
+        if not has_next and category != COMPLETED: 
+            # reopened and not completed again
+            finish_rows[item] = -1
+
+    return created_rows, start_rows, finish_rows, reopen_counts, dwell_days
+
+
+def _flow_rows_numpy(numpy, item_column, date_column, state_column, category_column, item_count, as_of_seconds, with_dwell=True): 
+    # the same as _flow_rows_python, as column operations over all items
+    items = numpy.asarray(item_column, dtype=numpy.int64)
+    categories = numpy.asarray(category_column, dtype=numpy.int64)
+    # DevOps dates are UTC, datetime64 takes them without the Z
+    seconds = numpy.asarray([changed_date[:-1] if changed_date.endswith('Z') else changed_date 
+        for changed_date in date_column], dtype='datetime64[ms]').astype(numpy.int64) / 1000.0
+    row_count = len(items)
+    rows = numpy.arange(row_count)
+
+    has_previous = numpy.zeros(row_count, dtype=bool)
+    has_previous[1:] = items[1:] == items[:-1]
+    has_next = numpy.zeros(row_count, dtype=bool)
+    has_next[:-1] = has_previous[1:]
+    previous_categories = numpy.where(has_previous, numpy.roll(categories, 1), UNCATEGORIZED)
+
+    def first_rows(mask): 
+        result = numpy.full(item_count, row_count)
+        numpy.minimum.at(result, items[mask], rows[mask])
+        return numpy.where(result == row_count, -1, result)
+
+    def last_rows(mask): 
+        result = numpy.full(item_count, -1)
+        numpy.maximum.at(result, items[mask], rows[mask])
+        return result
+
+    created_rows = first_rows(categories == PROPOSED)
+    start_rows = first_rows(categories == IN_PROGRESS)
+    # the finish only holds while the item stays completed
+    entered = last_rows((categories == COMPLETED) & (previous_categories != COMPLETED))
+    last = last_rows(numpy.ones(row_count, dtype=bool))
+    completed = (last >= 0) & (categories[numpy.maximum(last, 0)] == COMPLETED)
+    finish_rows = numpy.where(completed, entered, -1)
+    reopen_counts = numpy.bincount(items[(previous_categories == COMPLETED) & (categories != COMPLETED)], 
+        minlength=item_count)
+
+    dwell_days = None
+    if with_dwell: 
+        state_names, states = numpy.unique(numpy.asarray(state_column, dtype=object).astype(str), return_inverse=True)
+        done = (categories == COMPLETED) | (categories == REMOVED)
+        durations = numpy.where(has_next, numpy.roll(seconds, -1) - seconds, 
+            numpy.where(done, 0, as_of_seconds - seconds))
+        state_count = len(state_names)
+        dwell_matrix = numpy.bincount(items * state_count + states, weights=durations, 
+            minlength=item_count * state_count).reshape(item_count, state_count)
+
+        dwell_days = [{} for item in range(item_count)]
+        state_names = state_names.tolist()
+        dwell_items, dwell_states = numpy.nonzero(dwell_matrix)
+        for item, state, duration in zip(dwell_items.tolist(), dwell_states.tolist(), 
+                (dwell_matrix[dwell_items, dwell_states] / SECONDS_PER_DAY).tolist()): 
+            dwell_days[item][state_names[state]] = duration
+
+    return (created_rows.tolist(), start_rows.tolist(), finish_rows.tolist(), reopen_counts.tolist(), 
+        dwell_days, seconds.tolist())
+
+
+def compute_flow_metrics(work_item_list, revision_histories, state_categories=None, as_of=None, with_dwell=False): 
+    # {id: flow metrics} of the work items from their state changes. 
+    # created, start and finish are the DevOps dates of the first Proposed, 
+    # the first InProgress and the last Completed state, finish is None 
+    # when the item was reopened since. state_dwell_days adds up the days 
+    # spent in each state, until as_of for the state the item is still in, 
+    # with_dwell only (None otherwise), the exports don't use it. 
+    # as of a snapshot, the updates after the rev of the work item are left out
+    if state_categories is None: 
+        state_categories = work_item_state_categories
+    if as_of is None: 
+        as_of = snapshot_as_of
+    snapshot = as_of is not None
+    if as_of is None: 
+        as_of = datetime.now(pytz.utc)
+    category_lookup, fallback_lookup = _compile_state_categories(state_categories)
+
+    # flatten the state changes of all items into one table
+    id_list = []
+    item_column = []
+    date_column = []
+    state_column = []
+    category_column = []
+    for item, work_item in enumerate(work_item_list): 
+        item_id = work_item.id
+        categories = category_lookup.get(work_item.get('System.WorkItemType'), fallback_lookup)
+        id_list.append(item_id)
+        for revision in revision_histories.get(item_id) or []: 
+            if snapshot and work_item.rev is not None and (revision.rev or 0) > work_item.rev: 
+                break
+            field_revision = revision.fields
+            if field_revision is None or 'System.State' not in field_revision: 
+                # skip any update not changing the state
+                continue
+            state = field_revision['System.State'].new_value
+            item_column.append(item)
+            date_column.append(field_revision['System.ChangedDate'].new_value)
+            state_column.append(state)
+            category_column.append(categories.get(state, UNCATEGORIZED))
+
+    numpy = _import_numpy()
+    if numpy is not None and len(item_column) > 0: 
+        created_rows, start_rows, finish_rows, reopen_counts, dwell_days, seconds_column = _flow_rows_numpy(
+            numpy, item_column, date_column, state_column, category_column, len(id_list), as_of.timestamp(), with_dwell)
+    else: 
+        seconds_column = [_date_seconds(changed_date) for changed_date in date_column]
+        created_rows, start_rows, finish_rows, reopen_counts, dwell_days = _flow_rows_python(
+            item_column, seconds_column, state_column, category_column, len(id_list), as_of.timestamp(), with_dwell)
+
+    def days_between(first_row, last_row): 
+        if first_row < 0 or last_row < 0: 
+            return None
+        return (seconds_column[last_row] - seconds_column[first_row]) / SECONDS_PER_DAY
+
+    flow_metrics = {}
+    for item, item_id in enumerate(id_list): 
+        created_row = created_rows[item]
+        start_row = start_rows[item]
+        finish_row = finish_rows[item]
+        flow_metrics[item_id] = {
+            'created': date_column[created_row] if created_row >= 0 else None, 
+            'start': date_column[start_row] if start_row >= 0 else None, 
+            'finish': date_column[finish_row] if finish_row >= 0 else None, 
+            'lead_time_days': days_between(created_row, finish_row), 
+            'cycle_time_days': days_between(start_row, finish_row), 
+            'reopen_count': reopen_counts[item], 
+            'state_dwell_days': None if dwell_days is None else dwell_days[item]
+        }
+
+    return flow_metrics
+
+
+def _lead_duration(metrics): 
+    # (start, finish, lead time days, cycle time days, reopen count), the 
+    # start falls back to the creation for items never started
+    return (metrics['created'] if metrics['start'] is None else metrics['start']), metrics['finish'], \
+        metrics['lead_time_days'], metrics['cycle_time_days'], metrics['reopen_count']
+
+
+def get_lead_duration(team_context, item_id, rev=None, cache=None, state_categories=None): 
+    work_item = WorkItemRecord(item_id, rev, {'System.Id': item_id})
+    revision_history = get_revision_history(team_context, item_id, rev, cache)
+    flow_metrics = compute_flow_metrics([work_item], {item_id: revision_history}, state_categories)
+    return _lead_duration(flow_metrics[item_id])[:2]
+
+
+def get_lead_durations(team_context, work_item_list, max_workers=MAX_WORKERS, cache=None, state_categories=None): 
+    # {id: (start, finish, lead time, cycle time, reopens)} of the work items, see _lead_duration
+    with export_metrics.stage('revisions'): 
+        revision_histories = get_revision_histories(team_context, work_item_list, max_workers, cache)
+    with export_metrics.stage('flow_metrics'): 
+        flow_metrics = compute_flow_metrics(work_item_list, revision_histories, state_categories)
+    return dict((item_id, _lead_duration(metrics)) for item_id, metrics in flow_metrics.items())
 
 
 def compose_item_url(team_context, item_id): 
@@ -327,87 +1876,159 @@ def compose_item_url(team_context, item_id):
     return item_url_template.replace("{ORG_URL}", organization_url).replace("{PROJECT}", team_context.project).replace("{TEAM}", team_context.team).replace("{ID}", str(item_id))
 
 
-def write_pbi_to_workbook(work_item_list, worksheet, iteration_due_date, append_only): 
+def _format_export_timestamp(iteration_due_date): 
+    if isinstance(iteration_due_date, datetime): 
+        return iteration_due_date.strftime("%Y-%m-%d")
+    return None
+
+
+class TagClassifier: 
+    # the values of the tag columns of tag_classification_rules. the rules of
+    # each column are compiled into one regex, searched once in each tag, so
+    # rules of different columns matching at the same place all count
+
+    def __init__(self, rules): 
+        self.column_names = list(rules.keys())
+        self.defaults = [rules[column_name].get('default') for column_name in self.column_names]
+        # (column, value) of each rule, in the order of the rules
+        self.rule_targets = []
+        # (column, regex) of each column with rules
+        self.patterns = []
+        for column, column_name in enumerate(self.column_names): 
+            pattern_list = []
+            for rule in rules[column_name]['rules']: 
+                pattern_list.append('(?P<rule{0}>{1})'.format(len(self.rule_targets), rule['match']))
+                self.rule_targets.append((column, rule['value']))
+            # a lookahead finds the rules starting at every position, also inside another match
+            if len(pattern_list) > 0: 
+                self.patterns.append((column, re.compile('(?=' + '|'.join(pattern_list) + ')', re.IGNORECASE)))
+        # tags repeat a lot across work items, so each distinct value is parsed once
+        self.classify = lru_cache(maxsize=4096)(self._classify)
+
+    def _classify(self, tags): 
+        # the column values of a ;-separated tag list
+        first_rules = [None] * len(self.column_names)
+        for tag in tags.split(';'): 
+            tag = tag.strip()
+            for column, pattern in self.patterns: 
+                for match in pattern.finditer(tag): 
+                    rule = int(match.lastgroup[4:])
+                    if first_rules[column] is None or rule < first_rules[column]: 
+                        first_rules[column] = rule
+        return tuple([self.defaults[column] if first_rules[column] is None else self.rule_targets[first_rules[column]][1] 
+            for column in range(len(self.column_names))])
+
+    def classify_batch(self, tags_list): 
+        # the column values of many tag lists, each distinct one classified once
+        classes = dict((tags, self.classify(tags)) for tags in set(tags_list))
+        return [classes[tags] for tags in tags_list]
+
+
+def load_tag_rules(file_path): 
+    # {column: {'default': value, 'rules': [{'match': regex, 'value': value}]}} 
+    # from a json file, the columns not in the file keep their default rules
+    with open(file_path, 'r') as tag_rules_file: 
+        tag_rules = json.load(tag_rules_file)
+
+    for column_name, column_rules in tag_rules.items(): 
+        for rule in column_rules.get('rules', []): 
+            if 'match' not in rule or 'value' not in rule: 
+                raise Exception("Rule {0} of {1} in {2} needs a match and a value.".format(
+                    json.dumps(rule), column_name, file_path))
+            try: 
+                re.compile(rule['match'])
+            except re.error as e: 
+                raise Exception("Invalid match ({0}) of {1} in {2}: {3}".format(
+                    rule['match'], column_name, file_path, e))
+        column_rules.setdefault('rules', [])
+
+    merged_tag_rules = dict(tag_classification_rules)
+    merged_tag_rules.update(tag_rules)
+    return merged_tag_rules
+
+
+tag_classifier = TagClassifier(tag_classification_rules)
+
+
+def _field_extractor(field_name, transform=None): 
+    # the value of a field, or None when the work item doesn't have it
+    index = record_field_index.get(field_name)
+    if index is None: 
+        return lambda values, lead_duration: None
+    if transform is None: 
+        return lambda values, lead_duration: values[index]
+    return lambda values, lead_duration: \
+        transform(values[index], lead_duration) if values[index] is not None else None
+
+
+def _tag_extractor(classifier, column): 
+    return _field_extractor('System.Tags', lambda value, lead_duration: classifier.classify(value)[column])
+
+
+def compile_pbi_row_plan(team_context, iteration_due_date): 
+    # one extractor per column of pbi_export_field_names, taking the values 
+    # of a WorkItemRecord and its (start, finish) dates
+    export_timestamp = _format_export_timestamp(iteration_due_date)
+    item_url_prefix = None
+    if team_context is not None: 
+        item_url_prefix = compose_item_url(team_context, '')
+
+    row_plan = []
+    for field_name in pbi_export_field_names: 
+        if field_name == 'System.Tags': 
+            extractor = _field_extractor(field_name, lambda value, lead_duration: value.upper())
+        elif field_name == 'System.CreatedDate': 
+            # set the start working date
+            extractor = _field_extractor(field_name, lambda value, lead_duration: lead_duration[0])
+        elif field_name == 'System.ChangedDate': 
+            # set the finish working date
+            extractor = _field_extractor(field_name, lambda value, lead_duration: lead_duration[1])
+        elif field_name in tag_classifier.column_names: 
+            extractor = _tag_extractor(tag_classifier, tag_classifier.column_names.index(field_name))
+        elif field_name == 'Excel.ItemUrl': 
+            extractor = _field_extractor('System.Id', lambda value, lead_duration: 
+                None if item_url_prefix is None else item_url_prefix + str(value))
+        elif field_name == 'Export.Timestamp': 
+            extractor = lambda values, lead_duration: export_timestamp
+        elif field_name in flow_export_field_names: 
+            extractor = lambda values, lead_duration, index=2 + flow_export_field_names.index(field_name): lead_duration[index]
+        else: 
+            extractor = _field_extractor(field_name)
+        row_plan.append(extractor)
+
+    return row_plan
+
+
+def project_pbi_rows(work_item_list, row_plan, lead_durations=None): 
+    # (start, finish, ...) by work item id, see get_lead_durations
+    if lead_durations is None: 
+        lead_durations = {}
+
+    no_lead_duration = (None, None, None, None, None)
+    for work_item in work_item_list: 
+        values = work_item.values
+        lead_duration = lead_durations.get(work_item.id, no_lead_duration)
+        yield tuple([extract(values, lead_duration) for extract in row_plan])
+
+
+def write_pbi_to_workbook(work_item_list, worksheet, iteration_due_date, append_only, lead_durations=None, team_context=None): 
     # prepare the excel file 
     ws = worksheet
 
-    export_field_names = copy.deepcopy(pbi_field_names)
-    export_field_names.append('Excel.Operation') 
-    export_field_excel_operation_index = len(export_field_names)
-    export_field_names.append('Excel.Region')
-    export_field_excel_region_index = len(export_field_names)
-    export_field_names.append('Excel.Planned')
-    export_field_excel_planned_index = len(export_field_names)
+    row_plan = compile_pbi_row_plan(team_context, iteration_due_date)
 
-    export_field_names.append('Excel.ItemUrl') # Item URL to DevOps
-    export_field_excel_itemUrl_index = len(export_field_names)
-
-    export_field_names.append('Export.Timestamp') # Export.DueDate
-    export_field_export_timestamp_index = len(export_field_names)
-    if isinstance(iteration_due_date, datetime): 
-        export_timestamp = iteration_due_date.strftime("%Y-%m-%d")
-
-    start_row = 0
     if append_only == False:
         # write the headers to the workbook
-        for f in range(len(export_field_names)): 
-            simple_name = export_field_names[f].split('.')[-1]
-            ws.cell(row=1, column=f+1, value=simple_name)
-        start_row = 2
-    else:
-        start_row = ws.max_row + 1
-
-    # write data to the workbook 
-    for i in range(len(work_item_list)): 
-        work_item = work_item_list[i]
-        r = i + start_row
-        start_date = None
-        finish_date = None
-        for f in range(len(export_field_names)):
-            field_name = export_field_names[f] 
-            field_value = None
-            if field_name == 'Export.Timestamp':
-                ws.cell(row=r, column=export_field_export_timestamp_index, value=export_timestamp)
-            elif field_name in work_item.fields.keys():
-                fc = export_field_names.index(field_name)
-                # set the cell value
-                field_value = work_item.fields[field_name]
-                # further process the cell value
-                if field_name == 'System.Id': 
-                    ws.cell(row=r, column=export_field_excel_itemUrl_index, value=compose_item_url(team_context, field_value))
-                    start_date, finish_date = get_lead_duration(team_context, field_value)
-                elif field_name == 'System.Tags': 
-                    field_value = field_value.upper()
-                    # parse the tags for operation
-                    if field_value.find('ELECTRIC') > -1: 
-                        ws.cell(row=r, column=export_field_excel_operation_index, value='Eletric')
-                    elif field_value.find('GAS') > -1: 
-                        ws.cell(row=r, column=export_field_excel_operation_index, value='Gas')
-                    else: # count as both 
-                        ws.cell(row=r, column=export_field_excel_operation_index, value='Both')
-                    # parse the tags for region
-                    if field_value.find('INOH') > -1: 
-                        ws.cell(row=r, column=export_field_excel_region_index, value='INOH')
-                    # parse the tags for Planned or Unplanned 
-                    if field_value.find('UNPLANNED') > -1: 
-                        ws.cell(row=r, column=export_field_excel_planned_index, value='Unplanned')
-                    else: 
-                        ws.cell(row=r, column=export_field_excel_planned_index, value='Planned')
-                elif field_name == 'System.AssignedTo': 
-                    # simplify the AssignedTo object 
-                    field_value = work_item.fields["System.AssignedTo"]['displayName']
-                elif field_name in ['System.CreatedDate']: 
-                    # set the start working date
-                    field_value = start_date
-                elif field_name in ['System.ChangedDate']:
-                    # set the finish working date
-                    field_value = finish_date
-                ws.cell(row=r, column=fc+1, value=field_value)
+        ws.append([field_name.split('.')[-1] for field_name in pbi_export_field_names])
+
+    # write data to the workbook, one row per work item
+    for row in project_pbi_rows(work_item_list, row_plan, lead_durations): 
+        ws.append(row)
 
     return ws
 
 
-def write_pbi_to_excel(work_item_list, file_path, sheet_name, iteration_due_date, append_only=False):
+def write_pbi_to_excel(work_item_list, file_path, sheet_name, iteration_due_date, append_only=False, lead_durations=None, team_context=None):
     ws = None
     if append_only == True:
         # load the excel file
@@ -419,71 +2040,123 @@ def write_pbi_to_excel(work_item_list, file_path, sheet_name, iteration_due_date
     ws = wb.active
     ws.title = sheet_name
 
-    write_pbi_to_workbook(work_item_list, ws, iteration_due_date, append_only)
+    write_pbi_to_workbook(work_item_list, ws, iteration_due_date, append_only, lead_durations, team_context)
 
     # save to a given file
     wb.save(file_path)    
 
 
-def get_capacities(team_context, iteration_id, iteration_path): 
+def _count_working_days(start_date, finish_date, days_off_list): 
+    # weekdays from start to finish (both included) not covered by days off
+    days_off = set()
+    for date_range in days_off_list: 
+        day = date_range.start.date()
+        while day <= date_range.end.date(): 
+            days_off.add(day)
+            day += timedelta(days=1)
+
+    working_days = 0
+    day = start_date.date()
+    while day <= finish_date.date(): 
+        if day.weekday() < 5 and day not in days_off: 
+            working_days += 1
+        day += timedelta(days=1)
+    return working_days
+
+
+def get_capacities(team_context, iteration_id, iteration_path, start_date=None, finish_date=None): 
     # get capacties for each developer
     work_client = connection.clients.get_work_client()
 
     capacity_list = []
 
-    get_capacities_response = work_client.get_capacities_with_identity_ref(team_context, iteration_id)
+    get_capacities_response = _call_with_retry(
+        work_client.get_capacities_with_identity_ref, team_context, iteration_id)
+
+    # the days off of the whole team count for every member
+    team_days_off = []
+    if start_date is not None and finish_date is not None: 
+        get_team_days_off_response = _call_with_retry(
+            work_client.get_team_days_off, team_context, iteration_id)
+        if get_team_days_off_response is not None and get_team_days_off_response.days_off is not None: 
+            team_days_off = get_team_days_off_response.days_off
+
     if get_capacities_response is not None: 
         for dev_capacity in get_capacities_response: 
             team_member = dev_capacity.team_member.display_name
             capacity_per_day = 0
             for dev_activity in dev_capacity.activities: 
                 capacity_per_day += dev_activity.capacity_per_day
+            days_per_iteration = DAYS_PER_ITERATION
+            if start_date is not None and finish_date is not None: 
+                days_per_iteration = _count_working_days(start_date, finish_date, 
+                    team_days_off + (dev_capacity.days_off or []))
             capacity_list.append({
                 'team_member': team_member, 
                 'IterationPath': iteration_path, 
-                'days_per_iteration': DAYS_PER_ITERATION, 
-                'capacity_per_day': capacity_per_day
+                'days_per_iteration': days_per_iteration, 
+                'capacity_per_day': capacity_per_day, 
+                'team': team_context.team
             })
     return capacity_list
 
 
+def get_team_capacities(iteration_indexes, iteration_path_list, max_workers=MAX_WORKERS): 
+    # capacities of every team (one TeamIterationIndex each) for every 
+    # iteration, fetched concurrently. returns the capacity rows by iteration
+    # path, in the order of the teams. 
+    capacity_requests = []
+    for iteration_path in iteration_path_list: 
+        for iteration_index in iteration_indexes: 
+            iteration = iteration_index.get(iteration_path)
+            if iteration is not None: 
+                capacity_requests.append((iteration_index.team_context, iteration))
+
+    capacities_by_iteration = dict((iteration_path, []) for iteration_path in iteration_path_list)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor: 
+        results = executor.map(lambda capacity_request: get_capacities(capacity_request[0], 
+            capacity_request[1]['iteration_id'], capacity_request[1]['iteration_path'], 
+            capacity_request[1]['iteration_start_date'], capacity_request[1]['iteration_due_date']), 
+            capacity_requests)
+        for (team_context, iteration), capacity_list in zip(capacity_requests, results): 
+            capacities_by_iteration[iteration['iteration_path']].extend(capacity_list)
+
+    return capacities_by_iteration
+
+
+def compile_capacity_row_plan(iteration_due_date): 
+    # one extractor per column of capacity_export_field_names
+    export_timestamp = _format_export_timestamp(iteration_due_date)
+
+    row_plan = []
+    for field_name in capacity_export_field_names: 
+        if field_name == 'Export.Timestamp': 
+            extractor = lambda dev_capacity: export_timestamp
+        else: 
+            extractor = lambda dev_capacity, field_name=field_name: dev_capacity.get(field_name)
+        row_plan.append(extractor)
+
+    return row_plan
+
+
+def project_capacity_rows(capacity_list, row_plan): 
+    for dev_capacity in capacity_list: 
+        yield tuple([extract(dev_capacity) for extract in row_plan])
+
+
 def write_capacity_to_workbook(capacity_list, worksheet, iteration_due_date, append_only): 
     # prepare the excel file 
     ws = worksheet
 
-    export_field_names = copy.deepcopy(capacity_field_names)
-
-    export_field_names.append('Export.Timestamp') # Export.DueDate
-    export_field_export_timestamp_index = len(export_field_names)
-    if isinstance(iteration_due_date, datetime): 
-        export_timestamp = iteration_due_date.strftime("%Y-%m-%d")
+    row_plan = compile_capacity_row_plan(iteration_due_date)
 
-    start_row = 0
     if append_only == False:
         # write the headers to the workbook
-        for f in range(len(export_field_names)): 
-            simple_name = export_field_names[f].split('.')[-1]
-            ws.cell(row=1, column=f+1, value=simple_name)
-        start_row = 2
-    else:
-        start_row = ws.max_row + 1
-
-    # write data to the workbook 
-    for i in range(len(capacity_list)): 
-        dev_capacity = capacity_list[i]
-        r = i + start_row
-        start_date = None
-        finish_date = None
-        for f in range(len(export_field_names)):
-            field_name = export_field_names[f] 
-            field_value = None
-            if field_name == 'Export.Timestamp':
-                ws.cell(row=r, column=export_field_export_timestamp_index, value=export_timestamp)
-            elif field_name in dev_capacity.keys():
-                fc = export_field_names.index(field_name)
-                # set the cell value
-                field_value = dev_capacity[field_name]
-                ws.cell(row=r, column=fc+1, value=field_value)
+        ws.append([field_name.split('.')[-1] for field_name in capacity_export_field_names])
+
+    # write data to the workbook, one row per team member
+    for row in project_capacity_rows(capacity_list, row_plan): 
+        ws.append(row)
 
     return ws
 
@@ -506,87 +2179,1091 @@ def write_capacity_to_excel(capacity_list, file_path, sheet_name, iteration_due_
     wb.save(file_path)    
 
 
-if __name__ == "__main__": 
-    parser = argparse.ArgumentParser(description='Retrieve work items from Azure DevOps for a given or current iteration.')
-    parser.add_argument('-p', '--project', metavar='<Project Name>', default='CNP.GIS',
-                        help='ex. CNP.GIS')
-    parser.add_argument('-t', '--team', metavar='<Team Name>', default='CNP.GIS Team',
-                        help='ex. CNP.GIS Team')
-    parser.add_argument('-i', '--iteration', metavar="<Iteration Path>", 
-                        help='ex. CNP.GIS\\Sprint 21.03-A')
+def _check_appended_header(file_path, existing_header, export_field_names): 
+    # rows appended under other columns would end up in the wrong columns
+    if export_field_names is None: 
+        return
+    header = [field_name.split('.')[-1] for field_name in export_field_names]
+    if list(existing_header) != header: 
+        raise Exception("The columns of {0} differ from this export, export to a new file instead of appending.".format(file_path))
+
+
+class _StreamWriter: 
+    # rows of all iterations go through self.ws.append
+
+    def write_pbi(self, work_item_list, iteration_due_date, lead_durations=None, team_context=None): 
+        write_pbi_to_workbook(work_item_list, self.ws, iteration_due_date, self.append_only, lead_durations, team_context)
+        self.append_only = True
+
+    def write_capacity(self, capacity_list, iteration_due_date): 
+        write_capacity_to_workbook(capacity_list, self.ws, iteration_due_date, self.append_only)
+        self.append_only = True
+
+
+class ExcelStreamWriter(_StreamWriter): 
+    # a write-only workbook kept open for all iterations and saved once on 
+    # close, instead of loading and saving the growing file per iteration
+
+    def __init__(self, file_path, sheet_name, append_existing=False, export_field_names=None): 
+        self.file_path = file_path
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet(sheet_name)
+        self.append_only = False
+        if append_existing and os.path.exists(file_path): 
+            # stream the existing rows over without materialising the workbook
+            existing_wb = load_workbook(file_path, read_only=True)
+            existing_rows = existing_wb.active.iter_rows(values_only=True)
+            existing_header = next(existing_rows, None)
+            if existing_header is not None: 
+                try: 
+                    _check_appended_header(file_path, existing_header, export_field_names)
+                except Exception: 
+                    existing_wb.close()
+                    raise
+                self.ws.append(existing_header)
+                for row in existing_rows: 
+                    self.ws.append(row)
+                self.append_only = True
+            existing_wb.close()
+
+    def close(self): 
+        # save next to the target first, so a failure never leaves half a file
+        temp_file_path = self.file_path + '.tmp'
+        self.wb.save(temp_file_path)
+        os.replace(temp_file_path, self.file_path)
+
+
+class CsvStreamWriter(_StreamWriter): 
+    # a csv file kept open for all iterations, existing files are appended to
+
+    def __init__(self, file_path, sheet_name, append_existing=False, export_field_names=None): 
+        self.file_path = file_path
+        self.append_only = False
+        if append_existing and os.path.exists(file_path): 
+            with open(file_path, 'r', newline='', encoding='utf-8') as existing_file: 
+                existing_header = next(csv.reader(existing_file), None)
+            if existing_header is not None: 
+                _check_appended_header(file_path, existing_header, export_field_names)
+                self.append_only = True
+        self._file = open(file_path, 'a' if self.append_only else 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+        self.ws = self
+
+    def append(self, row): 
+        self._writer.writerow(row)
+
+    def close(self): 
+        self._file.close()
+
+
+class RowBufferWriter(_StreamWriter): 
+    # the header and rows kept in memory, rendered as csv or json
+
+    def __init__(self): 
+        self.rows = []
+        self.append_only = False
+        self.ws = self
+
+    def append(self, row): 
+        self.rows.append(row)
+
+    def render(self, export_format): 
+        if export_format == 'json': 
+            header = self.rows[0] if len(self.rows) > 0 else []
+            return json.dumps([dict(zip(header, row)) for row in self.rows[1:]], default=str).encode('utf-8')
+        buffer = io.StringIO(newline='')
+        csv.writer(buffer).writerows(self.rows)
+        return buffer.getvalue().encode('utf-8')
+
+
+def _import_pyarrow(export_format): 
+    # pyarrow is only needed for the columnar formats
+    try: 
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.dataset
+    except ImportError: 
+        raise Exception("The {0} format requires pyarrow (pip install pyarrow).".format(export_format))
+    return pyarrow
+
+
+def _to_arrow_array(pyarrow, values, column_type): 
+    if column_type == 'int64': 
+        return pyarrow.array(values, pyarrow.int64())
+    elif column_type == 'float64': 
+        return pyarrow.array(values, pyarrow.float64())
+    elif column_type in ['timestamp', 'date']: 
+        # DevOps returns ISO 8601 strings, let arrow parse them 
+        values = [value if value is None or isinstance(value, str) else value.isoformat() 
+            for value in values]
+        if column_type == 'date': 
+            return pyarrow.array(values, pyarrow.string()).cast(pyarrow.date32())
+        return pyarrow.array(values, pyarrow.string()).cast(pyarrow.timestamp('ms', tz='UTC'))
+    return pyarrow.array([value if value is None else str(value) for value in values], pyarrow.string())
+
+
+class ArrowDatasetWriter: 
+    # a parquet or arrow (IPC) dataset partitioned by IterationPath. every 
+    # exported iteration becomes its own partition, exporting an iteration 
+    # again replaces its partition and leaves the others untouched
+
+    def __init__(self, folder_path, export_format, replace_iteration_paths=None): 
+        self.pyarrow = _import_pyarrow(export_format)
+        self.file_path = folder_path
+        self.export_format = export_format
+        # partitions removed on close when no rows were written to them
+        self.replace_iteration_paths = replace_iteration_paths
+        self._written_iteration_paths = set()
+        self._write_count = 0
+
+    def write_pbi(self, work_item_list, iteration_due_date, lead_durations=None, team_context=None): 
+        row_plan = compile_pbi_row_plan(team_context, iteration_due_date)
+        self._write_rows(pbi_export_field_names, project_pbi_rows(work_item_list, row_plan, lead_durations))
+
+    def write_capacity(self, capacity_list, iteration_due_date): 
+        row_plan = compile_capacity_row_plan(iteration_due_date)
+        self._write_rows(capacity_export_field_names, project_capacity_rows(capacity_list, row_plan))
+
+    def _write_rows(self, export_field_names, rows): 
+        pyarrow = self.pyarrow
+        columns = list(zip(*rows))
+        if len(columns) == 0: 
+            return
+        table = pyarrow.Table.from_arrays(
+            [_to_arrow_array(pyarrow, columns[f], export_column_types.get(export_field_names[f])) 
+                for f in range(len(export_field_names))], 
+            names=[field_name.split('.')[-1] for field_name in export_field_names])
+
+        # the first rows of a partition replace it, the next ones are added as new files
+        iteration_path_list = table.column('IterationPath').to_pylist()
+        written = pyarrow.array([iteration_path in self._written_iteration_paths 
+            for iteration_path in iteration_path_list], pyarrow.bool_())
+        self._written_iteration_paths.update(iteration_path_list)
+        file_format = 'parquet' if self.export_format == 'parquet' else 'ipc'
+        for existing_data_behavior, mask in [('delete_matching', pyarrow.compute.invert(written)), 
+                ('overwrite_or_ignore', written)]: 
+            part_table = table.filter(mask)
+            if part_table.num_rows == 0: 
+                continue
+            pyarrow.dataset.write_dataset(part_table, self.file_path, format=file_format, 
+                partitioning=['IterationPath'], partitioning_flavor='hive', 
+                basename_template='part-{0}-{{i}}.{1}'.format(self._write_count, self.export_format), 
+                existing_data_behavior=existing_data_behavior)
+            self._write_count += 1
+
+    def close(self): 
+        # every partition is complete once written
+        if self.replace_iteration_paths is None: 
+            return
+        pyarrow = self.pyarrow
+        partitioning = pyarrow.dataset.partitioning(
+            pyarrow.schema([('IterationPath', pyarrow.string())]), flavor='hive')
+        for iteration_path in self.replace_iteration_paths - self._written_iteration_paths: 
+            partition_folder = os.path.join(self.file_path, 
+                partitioning.format(pyarrow.dataset.field('IterationPath') == iteration_path)[0])
+            if os.path.exists(partition_folder): 
+                shutil.rmtree(partition_folder)
+
+
+def _iterate_export_rows(file_path, export_format): 
+    # the rows of an xlsx or csv export, header first
+    if export_format == 'xlsx': 
+        wb = load_workbook(file_path, read_only=True)
+        for row in wb.active.iter_rows(values_only=True): 
+            yield row
+        wb.close()
+    else: 
+        with open(file_path, 'r', newline='', encoding='utf-8') as export_file: 
+            for row in csv.reader(export_file): 
+                yield row
+
+
+class DeltaExportWriter(_StreamWriter): 
+    # replaces the rows of some iterations in an existing xlsx or csv export.
+    # the other rows keep their place, the new rows of an iteration take the
+    # place of its first old row (or go last for an iteration not exported yet)
+
+    def __init__(self, file_path, sheet_name, export_format, replace_iteration_paths): 
+        self.file_path = file_path
+        self.sheet_name = sheet_name
+        self.export_format = export_format
+        self.replace_iteration_paths = replace_iteration_paths
+        self.export_field_names = None
+        # the header is already in the file
+        self.append_only = True
+        self.ws = self
+        self._rows = []
+
+    def write_pbi(self, work_item_list, iteration_due_date, lead_durations=None, team_context=None): 
+        self.export_field_names = pbi_export_field_names
+        _StreamWriter.write_pbi(self, work_item_list, iteration_due_date, lead_durations, team_context)
+
+    def write_capacity(self, capacity_list, iteration_due_date): 
+        self.export_field_names = capacity_export_field_names
+        _StreamWriter.write_capacity(self, capacity_list, iteration_due_date)
+
+    def append(self, row): 
+        self._rows.append(row)
+
+    def close(self): 
+        if self.export_field_names is None: 
+            return
+        header = [field_name.split('.')[-1] for field_name in self.export_field_names]
+        path_column = header.index('IterationPath')
+
+        rows_by_iteration_path = {}
+        for row in self._rows: 
+            rows_by_iteration_path.setdefault(row[path_column], []).append(row)
+
+        # merge into a new file next to the export, then swap them
+        temp_file_path = self.file_path + '.delta'
+        writer = open_export_writer(temp_file_path, self.sheet_name, self.export_format)
+        existing_rows = _iterate_export_rows(self.file_path, self.export_format)
+        existing_header = list(next(existing_rows, None) or [])
+        if existing_header != header: 
+            writer.close()
+            os.remove(temp_file_path)
+            raise Exception("The columns of {0} differ from this export, remove the {1} file next to it to export all iterations again.".format(
+                self.file_path, DELTA_STATE_SUFFIX))
+
+        writer.ws.append(header)
+        for row in existing_rows: 
+            iteration_path = row[path_column]
+            if iteration_path in self.replace_iteration_paths: 
+                for new_row in rows_by_iteration_path.pop(iteration_path, []): 
+                    writer.ws.append(new_row)
+            else: 
+                writer.ws.append(row)
+        for new_rows in rows_by_iteration_path.values(): 
+            for new_row in new_rows: 
+                writer.ws.append(new_row)
+        writer.close()
+        os.replace(temp_file_path, self.file_path)
+
+
+def open_export_writer(file_path, sheet_name, export_format='xlsx', append_existing=False, replace_iteration_paths=None, export_field_names=None): 
+    # replace_iteration_paths updates an existing export in place, see DeltaExportWriter.
+    # export_field_names are checked against the header of an appended file
+    if replace_iteration_paths is not None and export_format in ['xlsx', 'csv']: 
+        return DeltaExportWriter(file_path, sheet_name, export_format, replace_iteration_paths)
+    elif export_format == 'xlsx': 
+        return ExcelStreamWriter(file_path, sheet_name, append_existing, export_field_names)
+    elif export_format == 'csv': 
+        return CsvStreamWriter(file_path, sheet_name, append_existing, export_field_names)
+    elif export_format in DATASET_FORMATS: 
+        return ArrowDatasetWriter(file_path, export_format, replace_iteration_paths)
+    raise Exception("Unknown export format ({0}).".format(export_format))
+
+
+def retrieve_iteration(team_context, iteration, cache=None, max_workers=MAX_WORKERS, with_tasks=False): 
+    # the work items of one iteration, independent of the other iterations
+    iteration_path = iteration['iteration_path']
+
+    with export_metrics.stage('work_items'): 
+        if with_tasks: 
+            if verbose: 
+                print("****** Retrieving PBIs and Tasks for {0} ....".format(iteration_path))
+            work_item_list, task_list = retrieve_PBIs_with_tasks(team_context, iteration_path, cache, max_workers)
+            rollup_tasks(work_item_list, index_children(task_list))
+        else: 
+            if verbose: 
+                print("****** Retrieving PBIs for {0} ....".format(iteration_path))
+            work_item_list = retrieve_PBIs(team_context, iteration_path, cache, max_workers)
+
+    if verbose: 
+        print("****** Retrieving revisions for {0} ....".format(iteration_path))
+    lead_durations = get_lead_durations(team_context, work_item_list, max_workers, cache)
+
+    return work_item_list, lead_durations
+
+
+def stream_iteration(team_context, iteration, put_chunk, cache=None, max_workers=MAX_WORKERS, with_tasks=False): 
+    # put_chunk((work item list, lead durations)) for the work items of an 
+    # iteration in the order of the query, at least once. the revisions of a 
+    # chunk are fetched while the next work items come in
+    iteration_path = iteration['iteration_path']
+    if with_tasks: 
+        # the roll-ups need every task of the iteration first
+        put_chunk(retrieve_iteration(team_context, iteration, cache, max_workers, with_tasks))
+        return
+
+    if verbose: 
+        print("****** Retrieving PBIs and revisions for {0} ....".format(iteration_path))
+    wiql_pbi_query = compose_wiql(pbi_wiql_template, team_context, iteration_path)
+
+    # create the client once before the workers share it
+    connection.clients.get_work_item_tracking_client()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor: 
+        pending = deque()
+        chunk_count = 0
+
+        def submit_chunk(work_item_list): 
+            pending.append((work_item_list, [executor.submit(get_revision_history, 
+                team_context, work_item.id, work_item.rev, cache) for work_item in work_item_list]))
+
+        def put_next_chunk(): 
+            work_item_list, futures = pending.popleft()
+            with export_metrics.stage('revisions'): 
+                revision_histories = dict((work_item.id, future.result()) 
+                    for work_item, future in zip(work_item_list, futures))
+            with export_metrics.stage('flow_metrics'): 
+                flow_metrics = compute_flow_metrics(work_item_list, revision_histories)
+            # waits while the writer is behind
+            put_chunk((work_item_list, dict((item_id, _lead_duration(metrics)) 
+                for item_id, metrics in flow_metrics.items())))
+
+        work_item_list = []
+        work_items = iterate_work_items(team_context, wiql_pbi_query, cache, max_workers)
+        while True: 
+            start = time.perf_counter()
+            work_item = next(work_items, None)
+            export_metrics.observe_stage('work_items', time.perf_counter() - start)
+            if work_item is None: 
+                break
+            work_item_list.append(work_item)
+            if len(work_item_list) >= PIPELINE_CHUNK_SIZE: 
+                submit_chunk(work_item_list)
+                chunk_count += 1
+                work_item_list = []
+                while len(pending) > PIPELINE_CHUNKS_IN_FLIGHT: 
+                    put_next_chunk()
+        if len(work_item_list) > 0 or chunk_count == 0: 
+            submit_chunk(work_item_list)
+        while len(pending) > 0: 
+            put_next_chunk()
+
+
+def pipeline_iterations(team_context, iteration_list, cache=None, max_workers=MAX_WORKERS, 
+        parallel_iterations=MAX_PARALLEL_ITERATIONS, with_tasks=False): 
+    # yield (iteration, work item list, lead durations, first chunk) in the 
+    # order of iteration_list, then of the query. up to parallel_iterations 
+    # iterations are retrieved at the same time, each through a bounded 
+    # queue, so only a few chunks per iteration are ever held in memory
+    stop_event = threading.Event()
+    chunk_queues = [queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for iteration in iteration_list]
+
+    def produce(iteration, chunk_queue): 
+        def put_chunk(chunk): 
+            while not stop_event.is_set(): 
+                try: 
+                    chunk_queue.put(chunk, timeout=0.5)
+                    return
+                except queue.Full: 
+                    pass
+            raise Exception("Export of {0} stopped.".format(iteration['iteration_path']))
+
+        try: 
+            if not stop_event.is_set(): 
+                stream_iteration(team_context, iteration, put_chunk, cache, max_workers, with_tasks)
+        finally: 
+            # the end of the iteration, also when it failed
+            chunk_queue.put(None)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, parallel_iterations))
+    try: 
+        futures = [executor.submit(produce, iteration, chunk_queue) 
+            for iteration, chunk_queue in zip(iteration_list, chunk_queues)]
+        for iteration, chunk_queue, future in zip(iteration_list, chunk_queues, futures): 
+            first_chunk = True
+            while True: 
+                chunk = chunk_queue.get()
+                if chunk is None: 
+                    break
+                yield iteration, chunk[0], chunk[1], first_chunk
+                first_chunk = False
+            # raise the error of the iteration, if any
+            future.result()
+    finally: 
+        # a failed write stops the iterations still running
+        stop_event.set()
+        for chunk_queue in chunk_queues: 
+            while not chunk_queue.empty(): 
+                chunk_queue.get_nowait()
+        executor.shutdown(wait=True)
+
+
+def retrieve_changed_items(team_context, watermark, work_item_types, cache=None, max_workers=MAX_WORKERS): 
+    # the work items of the area changed after the watermark, in any iteration.
+    # they go into the cache as well, with --batch the iteration fetches that
+    # follow read the items fetched here from the cache
+    wiql_delta_query = compose_wiql(delta_wiql_template, team_context, '', 
+        {'WorkItemTypes': work_item_types, 'Watermark': watermark})
 
-    args = parser.parse_args()
+    work_tracking_client = connection.clients.get_work_item_tracking_client()
 
-    # set the team context 
-    team_context = workModels.TeamContext(project=args.project, team=args.team)
+    idList = query_work_item_ids(team_context, wiql_delta_query, True, max_workers)
+    if idList is None: 
+        return []
+    batch_list = [idList[i:i + WORK_ITEM_BATCH_SIZE] 
+        for i in range(0, len(idList), WORK_ITEM_BATCH_SIZE)]
+
+    changed_item_list = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor: 
+        for work_item_list, fetched_count in executor.map(
+                lambda batch_id_list: _fetch_work_item_batch(work_tracking_client, batch_id_list, cache), batch_list): 
+            changed_item_list.extend(work_item_list)
+
+    print("total {0} work items changed since {1}".format(len(changed_item_list), watermark))
+    return changed_item_list
+
+
+class DeltaState: 
+    # the last --delta export: its watermark and the rev and iteration path
+    # of every exported PBI, kept in a json file next to the PBI output 
+    # (or only in memory without a file_path)
+
+    def __init__(self, file_path=None): 
+        self.file_path = file_path
+        self.watermark = None
+        self.items = {}
+        if file_path is not None and os.path.exists(file_path): 
+            with open(file_path, 'r') as state_file: 
+                state = json.load(state_file)
+            self.watermark = state['watermark']
+            self.items = dict((int(item_id), (rev, iteration_path)) 
+                for item_id, (rev, iteration_path) in state['items'].items())
+
+    def affected_iteration_paths(self, changed_item_list): 
+        # the iterations the changed items are in now or were in at the last
+        # export, tasks affect the iteration of their PBI
+        iteration_path_set = set()
+        for work_item in changed_item_list: 
+            if work_item.get('System.WorkItemType') == 'Task': 
+                parent = self.items.get(work_item.get('System.Parent'))
+                if parent is not None: 
+                    iteration_path_set.add(parent[1])
+            else: 
+                previous = self.items.get(work_item.id)
+                if previous is not None: 
+                    if previous[0] == work_item.rev: 
+                        # changed before the last export
+                        continue
+                    iteration_path_set.add(previous[1])
+            iteration_path_set.add(work_item.get('System.IterationPath'))
+        return iteration_path_set
+
+    def forget(self, iteration_path_set=None): 
+        # the PBIs of the iterations exported again, or of all iterations
+        self.items = dict((item_id, item) for item_id, item in self.items.items() 
+            if iteration_path_set is not None and item[1] not in iteration_path_set)
+
+    def track(self, work_item_list): 
+        for work_item in work_item_list: 
+            self.items[work_item.id] = (work_item.rev, work_item.get('System.IterationPath'))
+
+    def save(self, watermark): 
+        self.watermark = watermark
+        if self.file_path is None: 
+            return
+        temp_file_path = self.file_path + '.tmp'
+        with open(temp_file_path, 'w') as state_file: 
+            json.dump({'watermark': watermark, 
+                'items': dict((str(item_id), item) for item_id, item in self.items.items())}, state_file)
+        os.replace(temp_file_path, self.file_path)
+
+
+def load_batch(file_path): 
+    # [(file prefix, team context)] of a --batch file, ex. 
+    # {"teams": [{"project": "CNP.GIS", "team": "CNP.GIS Team", "area_path": "CNP.GIS\\Gas", 
+    #   "include_sub_areas": true, "name": "Gas"}]}
+    with open(file_path) as batch_file: 
+        batch = json.load(batch_file)
+
+    team_list = batch.get('teams') if isinstance(batch, dict) else None
+    if not isinstance(team_list, list) or len(team_list) == 0: 
+        raise Exception("No teams in the batch file ({0}).".format(file_path))
+
+    batch_team_list = []
+    file_prefixes = set()
+    for team in team_list: 
+        if not isinstance(team, dict) or not team.get('project') or not team.get('team'): 
+            raise Exception("Batch team without a project or team ({0}): {1}".format(file_path, team))
+        area_path = team.get('area_path')
+        file_prefix = team.get('name') or (area_path or team['team'])
+        # the name goes into the file names
+        file_prefix = re.sub(r'[\\/:*?"<>| ]+', '_', file_prefix)
+        if file_prefix in file_prefixes: 
+            raise Exception("Two batch teams export to {0}, give them a different name ({1}).".format(file_prefix, file_path))
+        file_prefixes.add(file_prefix)
+        batch_team_list.append((file_prefix, AreaTeamContext(project=team['project'], team=team['team'], 
+            area_path=area_path, include_sub_areas=bool(team.get('include_sub_areas', False)))))
+    return batch_team_list
+
+
+def load_iteration_indexes(team_context_list, start_year=ITERATION_START_YEAR, cache_folder=None): 
+    # the team iterations are downloaded once for all lookups
+    with export_metrics.stage('iterations'), ThreadPoolExecutor(max_workers=len(team_context_list)) as executor: 
+        return list(executor.map(
+            lambda team_context: TeamIterationIndex(team_context, start_year, cache_folder), 
+            team_context_list))
+
+
+def select_iterations(team_context, iteration_index, iteration_path=None, today=None): 
+    # the iterations of -i: the current one (None), the started ones (ALL) or the given one
+    if iteration_path == 'ALL': 
+        return get_past_iterations(team_context, iteration_index, today)
+
+    if iteration_path is None: 
+        print("****** Getting the current iteration ...")
+        iteration_id, iteration_path, iteration_due_date = get_current_iteration(team_context, iteration_index, today)
+    else: 
+        iteration_id, iteration_due_date = get_iteration(team_context, iteration_path, iteration_index, today)
+    return [{
+        'iteration_id': iteration_id, 
+        'iteration_path': iteration_path, 
+        'iteration_due_date': iteration_due_date
+    }]
 
-    iteration_id = None
-    iteration_path = None
-    iteration_list = []
 
+def export_file_paths(team_context, iteration_list, args, file_prefix=None): 
+    # (PBI file path, capacity file path) of the export, (None, None) without iterations
     pbi_file_name = None
     capacity_file_name = None
-    append_only = False
-
-    if args.iteration is None: 
-        print("****** Getting the current iteration ...")
-        iteration_id, iteration_path, iteration_due_date = get_current_iteration(team_context)
-        iteration_list.append({
-            'iteration_id': iteration_id, 
-            'iteration_path': iteration_path, 
-            'iteration_due_date': iteration_due_date
-        })
-    elif args.iteration == 'ALL': 
-        iteration_list = get_past_iterations(team_context)
-        pbi_file_name = 'CNP.GIS_2021_Sprint_{0}_Combined.xlsx'.format('PBI')
-        capacity_file_name = 'CNP.GIS_2021_Sprint_{0}_Combined.xlsx'.format('Capacity')
-    else: 
-        iteration_path = args.iteration
-        iteration_id, iteration_due_date = get_iteration(team_context, iteration_path)
-        iteration_list.append({
-            'iteration_id': iteration_id, 
-            'iteration_path': iteration_path, 
-            'iteration_due_date': iteration_due_date
-        })
-
-    for i in iteration_list: 
-        iteration_id = i['iteration_id']
+    if args.iteration == 'ALL': 
+        pbi_file_name = 'CNP.GIS_2021_Sprint_{0}_Combined'.format('PBI')
+        capacity_file_name = 'CNP.GIS_2021_Sprint_{0}_Combined'.format('Capacity')
+
+    if args.format in DATASET_FORMATS: 
+        # one dataset per project, every iteration is added as a partition
+        pbi_file_name = team_context.project + "_PBI"
+        capacity_file_name = team_context.project + "_Capacity"
+
+    if len(iteration_list) == 0: 
+        return None, None
+
+    if pbi_file_name is None: 
+        pbi_file_name = iteration_list[0]['iteration_path'].replace('\\', '_') + "_PBI"
+    if capacity_file_name is None: 
+        capacity_file_name = iteration_list[0]['iteration_path'].replace('\\', '_') + "_Capacity"
+    if file_prefix is not None: 
+        pbi_file_name = file_prefix + "_" + pbi_file_name
+        capacity_file_name = file_prefix + "_" + capacity_file_name
+    local_folder = os.getcwd()
+    return os.path.join(os.path.join(local_folder, r"iterations"), pbi_file_name + "." + args.format), \
+        os.path.join(os.path.join(local_folder, r"iterations"), capacity_file_name + "." + args.format)
+
+
+def export_team(team_context_list, args, cache=None, cache_folder=None, file_prefix=None): 
+    # export the PBIs of the first team of team_context_list, and the 
+    # capacities of all of them. file_prefix tells apart the files of the 
+    # teams of a --batch run
+    team_context = team_context_list[0]
+
+    pbi_writer = None
+    capacity_writer = None
+
+    iteration_indexes = load_iteration_indexes(team_context_list, args.start_year, cache_folder)
+    iteration_list = select_iterations(team_context, iteration_indexes[0], args.iteration)
+    pbi_file_path, capacity_file_path = export_file_paths(team_context, iteration_list, args, file_prefix)
+
+    delta_state = None
+    replace_iteration_paths = None
+    export_started = datetime.now(pytz.utc)
+    if args.delta and pbi_file_path is not None: 
+        delta_state = DeltaState(pbi_file_path + DELTA_STATE_SUFFIX)
+        if delta_state.watermark is not None and os.path.exists(pbi_file_path) and os.path.exists(capacity_file_path): 
+            print("****** Retrieving the changes since {0} ....".format(delta_state.watermark))
+            work_item_types = ['Product Backlog Item', 'Task'] if args.tasks else ['Product Backlog Item']
+            with export_metrics.stage('delta'): 
+                changed_item_list = retrieve_changed_items(team_context, delta_state.watermark, work_item_types, cache, args.workers)
+            replace_iteration_paths = delta_state.affected_iteration_paths(changed_item_list)
+
+            # the iterations not finished yet are exported again for their capacities
+            watermark_date = datetime.fromisoformat(delta_state.watermark.replace('Z', '+00:00')).date()
+            replace_iteration_paths.update([i['iteration_path'] for i in iteration_list 
+                if i['iteration_due_date'] is None or i['iteration_due_date'].date() >= watermark_date])
+
+            iteration_list = [i for i in iteration_list if i['iteration_path'] in replace_iteration_paths]
+            replace_iteration_paths = set([i['iteration_path'] for i in iteration_list])
+            delta_state.forget(replace_iteration_paths)
+            print("****** Updating {0} iterations in {1} ....".format(len(iteration_list), pbi_file_path))
+        else: 
+            # no earlier --delta export, export all and start tracking
+            delta_state.forget()
+
+    print("****** Retrieving Capacities for {0} iterations of {1} teams ....".format(
+        len(iteration_list), len(team_context_list)))
+    with export_metrics.stage('capacities'): 
+        capacities_by_iteration = get_team_capacities(iteration_indexes, 
+            [i['iteration_path'] for i in iteration_list], args.workers)
+
+    # retrieve the iterations concurrently and write them as they come in. 
+    # the chunks come in the order of iteration_list, so the combined 
+    # workbooks are merged in a deterministic order (by iteration, then by 
+    # the WIQL order)
+    for i, work_item_list, lead_durations, first_chunk in pipeline_iterations(
+            team_context, iteration_list, cache, args.workers, args.parallel_iterations, args.tasks): 
         iteration_path = i['iteration_path']
         iteration_due_date = i['iteration_due_date']
 
-        print("****** Retrieving PBIs for {0} ....".format(iteration_path))
-        work_item_list = retrieve_PBIs(team_context, iteration_path)
+        if pbi_writer is None: 
+            file_path = pbi_file_path
 
-        local_folder = os.getcwd()
-        if pbi_file_name is None: 
-            pbi_file_name = iteration_path.replace('\\', '_') + "_PBI.xlsx"
-        file_path = os.path.join(os.path.join(local_folder, r"iterations"), pbi_file_name)
+            if args.append == False and args.delta == False and args.format not in DATASET_FORMATS and os.path.exists(file_path):
+                raise Exception("File ({0}) already exists.".format(file_path))
 
-        if append_only == False and os.path.exists(file_path):
-            raise Exception("File ({0}) already exists.".format(file_path))
+            pbi_writer = open_export_writer(file_path, "current_iteration", args.format, args.append, replace_iteration_paths, 
+                pbi_export_field_names)
 
-        print("****** Storing work items to an Excel file {0} ....".format(file_path)) 
+        if verbose and first_chunk: 
+            print("****** Storing work items to {0} ....".format(pbi_writer.file_path)) 
         if iteration_due_date is None:
             iteration_due_date = datetime.now()
 
-        write_pbi_to_excel(work_item_list, file_path, "current_iteration", iteration_due_date, append_only)
-
-        print("****** Retrieving Capacities for {0} ....".format(iteration_path))
-        capacity_list = get_capacities(team_context, iteration_id, iteration_path)
-
-        if capacity_file_name is None: 
-            capacity_file_name = iteration_path.replace('\\', '_') + "_Capacity.xlsx"
-        file_path = os.path.join(os.path.join(local_folder, r"iterations"), capacity_file_name)
+        with export_metrics.stage('write'): 
+            pbi_writer.write_pbi(work_item_list, iteration_due_date, lead_durations, team_context)
+        export_metrics.count_rows('pbi', len(work_item_list))
+        if delta_state is not None: 
+            delta_state.track(work_item_list)
+
+        if not first_chunk: 
+            continue
+
+        # the capacities once per iteration
+        capacity_list = capacities_by_iteration.get(iteration_path, [])
+
+        if capacity_writer is None: 
+            file_path = capacity_file_path
+
+            if args.append == False and args.delta == False and args.format not in DATASET_FORMATS and os.path.exists(file_path):
+                raise Exception("File ({0}) already exists.".format(file_path))
+
+            capacity_writer = open_export_writer(file_path, "capacity", args.format, args.append, replace_iteration_paths, 
+                capacity_export_field_names)
+
+        if verbose: 
+            print("****** Storing capacities to {0} ....".format(capacity_writer.file_path)) 
+
+        with export_metrics.stage('write'): 
+            capacity_writer.write_capacity(capacity_list, iteration_due_date)
+        export_metrics.count_rows('capacity', len(capacity_list))
+
+    # each output is saved once, after all iterations
+    with export_metrics.stage('write'): 
+        if pbi_writer is not None: 
+            pbi_writer.close()
+        if capacity_writer is not None: 
+            capacity_writer.close()
+
+    if delta_state is not None: 
+        # the next --delta run starts from this one
+        delta_state.save((export_started - timedelta(seconds=DELTA_WATERMARK_OVERLAP_SECONDS)).strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+
+class ExportModel: 
+    # the export of a team kept in memory by --daemon: the iterations of -i, 
+    # their PBIs with the lead durations and their capacities. a refresh 
+    # fetches again the iterations with work items changed (ChangedDate) 
+    # since the last one, and the capacities of the iterations not finished
+
+    def __init__(self, team_context_list, args, cache=None, cache_folder=None): 
+        self.team_context_list = team_context_list
+        self.team_context = team_context_list[0]
+        self.args = args
+        self.cache = cache
+        self.cache_folder = cache_folder
+        self.iteration_indexes = None
+        self.iteration_indexes_loaded = None
+        self.iteration_list = []
+        # {iteration path: (work item list, lead durations)}
+        self.work_items = {}
+        # {iteration path: capacity list}
+        self.capacities = {}
+        self.delta_state = DeltaState()
+        self.version = 0
+        self.refreshed = None
+        self.last_error = None
+        # the iterations changed since the files were written
+        self.unwritten_iteration_paths = set()
+        self._lock = threading.Lock()
+        self._rendered = {}
+
+    def snapshot(self): 
+        # (version, iteration list, work items, capacities) of the same refresh
+        with self._lock: 
+            return self.version, self.iteration_list, self.work_items, self.capacities
+
+    def refresh(self): 
+        # returns whether the export changed
+        refresh_started = datetime.now(pytz.utc)
+        today = usa_cst.localize(datetime.now())
+        if self.iteration_indexes is None or time.monotonic() - self.iteration_indexes_loaded > ITERATION_CACHE_TTL_SECONDS: 
+            self.iteration_indexes = load_iteration_indexes(self.team_context_list, self.args.start_year, self.cache_folder)
+            self.iteration_indexes_loaded = time.monotonic()
+        iteration_list = [i for i in select_iterations(self.team_context, self.iteration_indexes[0], self.args.iteration, today) 
+            if i['iteration_path'] is not None]
+        iteration_paths = set([i['iteration_path'] for i in iteration_list])
+
+        # the iterations new to the export, and those of the changed work items
+        fetch_paths = iteration_paths - set(self.work_items.keys())
+        if self.delta_state.watermark is not None: 
+            work_item_types = ['Product Backlog Item', 'Task'] if self.args.tasks else ['Product Backlog Item']
+            with export_metrics.stage('delta'): 
+                changed_item_list = retrieve_changed_items(self.team_context, self.delta_state.watermark, 
+                    work_item_types, self.cache, self.args.workers)
+            fetch_paths.update(self.delta_state.affected_iteration_paths(changed_item_list) & iteration_paths)
+        # capacity changes don't show in the work items
+        capacity_paths = (iteration_paths - set(self.capacities.keys())) | set([i['iteration_path'] for i in iteration_list 
+            if i['iteration_due_date'] is None or i['iteration_due_date'].date() >= today.date()])
+
+        work_items = {}
+        for i, work_item_list, lead_durations, first_chunk in pipeline_iterations(self.team_context, 
+                [i for i in iteration_list if i['iteration_path'] in fetch_paths], 
+                self.cache, self.args.workers, self.args.parallel_iterations, self.args.tasks): 
+            iteration_work_items = work_items.setdefault(i['iteration_path'], ([], {}))
+            iteration_work_items[0].extend(work_item_list)
+            iteration_work_items[1].update(lead_durations)
+        with export_metrics.stage('capacities'): 
+            capacities = get_team_capacities(self.iteration_indexes, 
+                [i['iteration_path'] for i in iteration_list if i['iteration_path'] in capacity_paths], self.args.workers)
+
+        changed_paths = set([iteration_path for iteration_path, (work_item_list, lead_durations) in work_items.items() 
+            if _work_items_signature(self.work_items.get(iteration_path)) != _work_items_signature((work_item_list, lead_durations))])
+        changed_paths.update([iteration_path for iteration_path, capacity_list in capacities.items() 
+            if self.capacities.get(iteration_path) != capacity_list])
+        changed = len(changed_paths) > 0 or [(i['iteration_path'], i['iteration_due_date']) for i in iteration_list] \
+            != [(i['iteration_path'], i['iteration_due_date']) for i in self.iteration_list]
+
+        self.delta_state.forget(set(work_items.keys()))
+        for work_item_list, lead_durations in work_items.values(): 
+            self.delta_state.track(work_item_list)
+        self.delta_state.save((refresh_started - timedelta(seconds=DELTA_WATERMARK_OVERLAP_SECONDS)).strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+        with self._lock: 
+            # the iterations no longer exported are dropped
+            self.unwritten_iteration_paths.update(changed_paths | (set(self.work_items.keys()) - iteration_paths))
+            self.work_items = dict((iteration_path, work_items.get(iteration_path, self.work_items.get(iteration_path))) 
+                for iteration_path in iteration_paths)
+            self.capacities = dict((iteration_path, capacities.get(iteration_path, self.capacities.get(iteration_path, []))) 
+                for iteration_path in iteration_paths)
+            self.iteration_list = iteration_list
+            if changed: 
+                self.version += 1
+                self._rendered = {}
+            self.refreshed = datetime.now(pytz.utc)
+            self.last_error = None
+        return changed
+
+    def write_export(self, pbi_writer, capacity_writer, iteration_path_set=None): 
+        # the iterations in the order of -i, or those of iteration_path_set
+        version, iteration_list, work_items, capacities = self.snapshot()
+        for i in iteration_list: 
+            if iteration_path_set is not None and i['iteration_path'] not in iteration_path_set: 
+                continue
+            iteration_due_date = i['iteration_due_date']
+            if iteration_due_date is None: 
+                iteration_due_date = datetime.now()
+            if pbi_writer is not None: 
+                work_item_list, lead_durations = work_items[i['iteration_path']]
+                pbi_writer.write_pbi(work_item_list, iteration_due_date, lead_durations, self.team_context)
+            if capacity_writer is not None: 
+                capacity_writer.write_capacity(capacities.get(i['iteration_path'], []), iteration_due_date)
+        return version
+
+    def render(self, output_name, export_format): 
+        # the csv or json bytes of the 'pbi' or 'capacity' output, rendered 
+        # once per version
+        version = self.snapshot()[0]
+        key = (version, output_name, export_format)
+        rendered = self._rendered.get(key)
+        if rendered is None: 
+            writer = RowBufferWriter()
+            version = self.write_export(writer if output_name == 'pbi' else None, 
+                writer if output_name == 'capacity' else None)
+            rendered = writer.render(export_format)
+            with self._lock: 
+                if version == self.version: 
+                    self._rendered[(version, output_name, export_format)] = rendered
+        return version, rendered
+
+    def write_files(self): 
+        # the xlsx and csv files are written again whole, the datasets only
+        # in the iterations changed since the last write
+        pbi_file_path, capacity_file_path = export_file_paths(self.team_context, self.snapshot()[1], self.args)
+        if pbi_file_path is None: 
+            return
+        with self._lock: 
+            iteration_path_set = self.unwritten_iteration_paths
+            self.unwritten_iteration_paths = set()
+
+        if self.args.format in DATASET_FORMATS: 
+            pbi_writer = open_export_writer(pbi_file_path, "current_iteration", self.args.format, False, iteration_path_set)
+            capacity_writer = open_export_writer(capacity_file_path, "capacity", self.args.format, False, iteration_path_set)
+            self.write_export(pbi_writer, capacity_writer, iteration_path_set)
+            pbi_writer.close()
+            capacity_writer.close()
+            return
+
+        # next to the files first, so a reader never sees half a file
+        pbi_writer = open_export_writer(pbi_file_path + '.new', "current_iteration", self.args.format)
+        capacity_writer = open_export_writer(capacity_file_path + '.new', "capacity", self.args.format)
+        self.write_export(pbi_writer, capacity_writer)
+        pbi_writer.close()
+        capacity_writer.close()
+        os.replace(pbi_file_path + '.new', pbi_file_path)
+        os.replace(capacity_file_path + '.new', capacity_file_path)
+
+    def status(self): 
+        version, iteration_list, work_items, capacities = self.snapshot()
+        return {
+            'version': version, 
+            'refreshed': None if self.refreshed is None else self.refreshed.strftime("%Y-%m-%dT%H:%M:%SZ"), 
+            'watermark': self.delta_state.watermark, 
+            'iterations': [i['iteration_path'] for i in iteration_list], 
+            'work_items': sum([len(work_item_list) for work_item_list, lead_durations in work_items.values()]), 
+            'last_error': self.last_error
+        }
+
+
+def _work_items_signature(iteration_work_items): 
+    # what the export rows of an iteration depend on, besides the fixed columns
+    if iteration_work_items is None: 
+        return None
+    work_item_list, lead_durations = iteration_work_items
+    return [(work_item.id, work_item.rev, tuple(work_item.values)) for work_item in work_item_list], lead_durations
+
+
+class ExportRequestHandler(BaseHTTPRequestHandler): 
+    # GET /pbi.csv, /pbi.json, /capacity.csv, /capacity.json and /status 
+    # from the ExportModel of the server. the ETag is the export version
+
+    content_types = {'csv': 'text/csv; charset=utf-8', 'json': 'application/json'}
+
+    def do_GET(self): 
+        model = self.server.model
+        path = self.path.split('?')[0].strip('/')
+        if path == 'status': 
+            self._send(200, 'json', json.dumps(model.status()).encode('utf-8'))
+            return
+
+        output_name, _, export_format = path.partition('.')
+        if output_name not in ['pbi', 'capacity'] or export_format not in self.content_types: 
+            self._send(404, 'json', json.dumps({'error': "Unknown export ({0}).".format(self.path)}).encode('utf-8'))
+            return
+
+        etag = '"{0}"'.format(model.snapshot()[0])
+        if self.headers.get('If-None-Match') == etag: 
+            self._send(304, export_format, None, etag)
+            return
+        version, body = model.render(output_name, export_format)
+        self._send(200, export_format, body, '"{0}"'.format(version))
+
+    def _send(self, status, export_format, body, etag=None): 
+        self.send_response(status)
+        self.send_header('Content-Type', self.content_types[export_format])
+        if etag is not None: 
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(0 if body is None else len(body)))
+        self.end_headers()
+        if body is not None: 
+            self.wfile.write(body)
+
+    def log_message(self, format, *args): 
+        if verbose: 
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def run_daemon(team_context_list, args, cache=None, cache_folder=None): 
+    # keep the export of the first team in memory, refresh it every 
+    # args.refresh_interval seconds and write the files when it changed. 
+    # with args.port, serve it over http as well. stops on Ctrl+C or SIGTERM
+    model = ExportModel(team_context_list, args, cache, cache_folder)
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    server = None
+    try: 
+        while not stop_event.is_set(): 
+            refresh_started = time.perf_counter()
+            try: 
+                with export_metrics.stage('refresh'): 
+                    changed = model.refresh()
+                if changed: 
+                    with export_metrics.stage('write'): 
+                        model.write_files()
+                print("****** Refreshed in {0:.1f}s, export version {1}{2}".format(
+                    time.perf_counter() - refresh_started, model.version, "" if changed else " (unchanged)"))
+            except Exception as e: 
+                if model.version == 0: 
+                    # nothing to serve without the first export
+                    raise
+                model.last_error = str(e)
+                print("****** Refresh failed, keeping export version {0}: {1}".format(model.version, e))
+
+            if args.metrics is not None: 
+                if cache is not None: 
+                    # the hits and misses of the refreshes so far
+                    export_metrics.observe_cache(cache)
+                export_metrics.save(args.metrics, request_scheduler)
+
+            if server is None and args.port is not None: 
+                server = ThreadingHTTPServer((DAEMON_HOST, args.port), ExportRequestHandler)
+                server.daemon_threads = True
+                server.model = model
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                print("****** Serving the export on http://{0}:{1}/ (pbi.csv, pbi.json, capacity.csv, capacity.json, status) ....".format(
+                    DAEMON_HOST, server.server_address[1]))
+
+            stop_event.wait(args.refresh_interval)
+    except KeyboardInterrupt: 
+        pass
+    finally: 
+        print("****** Stopping the daemon ....")
+        if server is not None: 
+            server.shutdown()
+            server.server_close()
 
-        if append_only == False and os.path.exists(file_path):
-            raise Exception("File ({0}) already exists.".format(file_path))
 
-        print("****** Storing capacities to an Excel file {0} ....".format(file_path)) 
-        if iteration_due_date is None:
-            iteration_due_date = datetime.now()
+if __name__ == "__main__": 
+    parser = argparse.ArgumentParser(description='Retrieve work items from Azure DevOps for a given or current iteration.')
+    parser.add_argument('-p', '--project', metavar='<Project Name>', default='CNP.GIS',
+                        help='ex. CNP.GIS')
+    parser.add_argument('-t', '--team', metavar='<Team Name>', action='append',
+                        help='ex. CNP.GIS Team (repeat for the capacities of several teams, the first team exports the PBIs)')
+    parser.add_argument('-i', '--iteration', metavar="<Iteration Path>", 
+                        help='ex. CNP.GIS\\Sprint 21.03-A')
+    parser.add_argument('-w', '--workers', metavar='<Worker Count>', type=int, default=MAX_WORKERS,
+                        help='concurrent requests for work items and revisions (default: {0})'.format(MAX_WORKERS))
+    parser.add_argument('--max-requests-per-second', metavar='<Rate>', type=float, default=REQUEST_RATE_PER_SECOND, 
+                        help='upper bound of the DevOps request rate, 0 for none (default: {0})'.format(REQUEST_RATE_PER_SECOND))
+    parser.add_argument('--max-concurrent-requests', metavar='<Count>', type=int, default=MAX_CONCURRENT_REQUESTS, 
+                        help='upper bound of the adaptive request concurrency (default: {0})'.format(MAX_CONCURRENT_REQUESTS))
+    parser.add_argument('--parallel-iterations', metavar='<Iteration Count>', type=int, default=MAX_PARALLEL_ITERATIONS,
+                        help='iterations retrieved at the same time with ALL (default: {0})'.format(MAX_PARALLEL_ITERATIONS))
+    parser.add_argument('-f', '--format', choices=EXPORT_FORMATS, default='xlsx', 
+                        help='format of the exported files, parquet and arrow are partitioned by IterationPath (default: xlsx)')
+    parser.add_argument('--append', action='store_true', 
+                        help='append to existing xlsx/csv files instead of refusing to overwrite them')
+    parser.add_argument('--start-year', metavar='<Year>', type=int, default=ITERATION_START_YEAR, 
+                        help='skip the iterations starting before this year (default: {0})'.format(ITERATION_START_YEAR))
+    parser.add_argument('--no-cache', action='store_true', 
+                        help='always download work items and revisions, bypassing {0}'.format(CACHE_FOLDER))
+    parser.add_argument('--delta', action='store_true', 
+                        help='update the existing export with the work items changed since its last --delta run')
+    parser.add_argument('--tasks', action='store_true', 
+                        help='retrieve the child Tasks with the PBIs and export their remaining and completed work')
+    parser.add_argument('--flow-metrics', action='store_true', 
+                        help='export the lead time, cycle time (days) and reopen count of every PBI')
+    parser.add_argument('--state-categories', metavar='<JSON File>', 
+                        help='categories of the process states per work item type, ex. {"Bug": {"Resolved": "Completed"}}')
+    parser.add_argument('--tag-rules', metavar='<JSON File>', 
+                        help='rules of the columns derived from the tags, ex. {"Excel.Region": {"rules": [{"match": "INOH", "value": "INOH"}, {"match": "^TX", "value": "TX"}]}}')
+    parser.add_argument('--metrics', metavar='<Metrics File>', 
+                        help='save the stage times, API calls, cache hits and rows written as json, or as a Prometheus textfile when the name ends in .prom')
+    parser.add_argument('-q', '--quiet', action='store_true', 
+                        help='only print the progress of the stages, not every work item and iteration')
+    parser.add_argument('--as-of', metavar='<Date>', 
+                        help='export the work items as they were on a date, ex. 2021-03-31 or 2021-03-31T18:00:00Z (bypasses the cache)')
+    parser.add_argument('--daemon', action='store_true', 
+                        help='keep running with the export in memory, refresh it from the work items changed since the last refresh and write the files when it changed')
+    parser.add_argument('--refresh-interval', metavar='<Seconds>', type=float, default=DAEMON_REFRESH_SECONDS, 
+                        help='seconds between the --daemon refreshes (default: {0})'.format(DAEMON_REFRESH_SECONDS))
+    parser.add_argument('--port', metavar='<Port>', type=int, 
+                        help='serve the --daemon export on http://{0}:<Port>/pbi.csv (or .json), /capacity.csv and /status'.format(DAEMON_HOST))
+    parser.add_argument('--batch', metavar='<JSON File>', 
+                        help='export the teams listed in the file, ex. {"teams": [{"project": "CNP.GIS", "team": "CNP.GIS Team", "area_path": "CNP.GIS\\\\Gas", "include_sub_areas": true, "name": "Gas"}]}, each to its own files (replaces -p and -t)')
+    parser.add_argument('--parallel-teams', metavar='<Team Count>', type=int, default=MAX_PARALLEL_TEAMS, 
+                        help='teams exported at the same time with --batch (default: {0})'.format(MAX_PARALLEL_TEAMS))
+    parser.add_argument('--record', metavar='<Fixture Folder>', 
+                        help='record the DevOps responses to a folder (bypasses the cache)')
+    parser.add_argument('--replay', metavar='<Fixture Folder>', 
+                        help='serve the DevOps responses from a recorded folder, without network (bypasses the cache)')
 
-        write_capacity_to_excel(capacity_list, file_path, "capacity", iteration_due_date, append_only)
+    args = parser.parse_args()
 
-        append_only = True
+    if args.team is None: 
+        args.team = ['CNP.GIS Team']
+
+    verbose = not args.quiet
+
+    if args.replay is not None: 
+        # nothing to throttle without network
+        args.max_requests_per_second = 0
+    request_scheduler = RequestScheduler(args.max_requests_per_second, REQUEST_BURST, 
+        args.max_concurrent_requests, args.workers)
+
+    if args.state_categories is not None: 
+        work_item_state_categories = load_state_categories(args.state_categories)
+
+    if args.tag_rules is not None: 
+        tag_classifier = TagClassifier(load_tag_rules(args.tag_rules))
+        # new tag columns are exported after the others
+        pbi_export_field_names = pbi_export_field_names + [column_name 
+            for column_name in tag_classifier.column_names if column_name not in pbi_export_field_names]
+
+    if args.tasks: 
+        pbi_export_field_names = pbi_export_field_names + task_rollup_field_names
+
+    if args.flow_metrics: 
+        pbi_export_field_names = pbi_export_field_names + flow_export_field_names
+
+    if args.daemon and (args.batch is not None or args.as_of is not None): 
+        raise Exception("--daemon keeps the current export of one team, it can't be used with --batch or --as-of.")
+
+    if args.as_of is not None: 
+        if args.delta: 
+            raise Exception("--delta updates the current export, it can't be used with --as-of.")
+        # the queries and work items as of the date, the revisions until then
+        snapshot_as_of = datetime.fromisoformat(args.as_of.replace('Z', '+00:00'))
+        if snapshot_as_of.tzinfo is None: 
+            snapshot_as_of = usa_cst.localize(snapshot_as_of)
+        today_timezone = snapshot_as_of.astimezone(usa_cst)
+        # the cache holds the current work items
+        args.no_cache = True
+
+    record_store = None
+    if args.record is not None or args.replay is not None: 
+        # every call has to reach the recording or the replay
+        args.no_cache = True
+        if args.record is not None: 
+            record_store = FixtureStore(args.record)
+            connection = DevOpsSession(record_store=record_store)
+        else: 
+            connection = DevOpsSession(replay_store=FixtureStore(args.replay))
+
+    cache = None
+    cache_folder = None
+    if args.no_cache == False: 
+        cache_folder = os.path.join(os.getcwd(), CACHE_FOLDER)
+        cache = WorkItemCache(os.path.join(cache_folder, CACHE_FILE_NAME))
+
+    if args.batch is None: 
+        # set the team context, the PBIs are exported for the first team
+        team_context_list = [workModels.TeamContext(project=args.project, team=team) for team in args.team]
+        if args.daemon: 
+            run_daemon(team_context_list, args, cache, cache_folder)
+        else: 
+            export_team(team_context_list, args, cache, cache_folder)
+    else: 
+        batch_team_list = load_batch(args.batch)
+        print("****** Exporting {0} teams, {1} at a time ....".format(len(batch_team_list), args.parallel_teams))
+        # a work item or revision history wanted by several teams is fetched once
+        shared_fetches = SharedFetches(cache)
+        with ThreadPoolExecutor(max_workers=max(1, args.parallel_teams)) as executor: 
+            futures = [executor.submit(export_team, [team_context], args, cache, cache_folder, file_prefix) 
+                for file_prefix, team_context in batch_team_list]
+            for future in futures: 
+                future.result()
+        print("****** {0} work items and revision histories fetched for all teams, {1} shared ....".format(
+            shared_fetches.fetched_count, shared_fetches.shared_count))
+
+    print("****** {0} requests, {1} throttled, up to {2} at once (limit now {3})".format(
+        request_scheduler.call_count, request_scheduler.throttled_count, 
+        request_scheduler.peak_concurrency, int(request_scheduler.limit)))
+
+    if record_store is not None: 
+        print("****** Saving the recorded responses to {0} ....".format(record_store.folder))
+        record_store.save()
+
+    if cache is not None: 
+        print("****** Compacting the cache ({0} hits, {1} misses) ....".format(cache.hits, cache.misses))
+        export_metrics.observe_cache(cache)
+        cache.compact()
+        cache.close()
+
+    if args.metrics is not None: 
+        print("****** Saving the run metrics to {0} ....".format(args.metrics))
+        export_metrics.save(args.metrics, request_scheduler)
 
     print("****** Completed")